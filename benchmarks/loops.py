@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Benchmark loop detection on synthetic tracks with known loop points.
+
+Each track is an intro followed by a loop body that repeats partly at the
+end, encoded to FLAC with ffmpeg.  For each track, decoding, a single
+correlation and the full loop search are timed separately, and the loop
+found is checked against the real one.
+
+Any crosslooper option (e.g. --channels or --loop-search-coarse-rate) is
+applied to every track.  The cache is off unless --cache-size is given.
+"""
+
+import dataclasses
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import crosslooper  # noqa: E402
+
+
+@dataclasses.dataclass(frozen=True)
+class Case:
+    """A synthetic track; times are in seconds."""
+    name: str
+    intro: float = 8.0
+    body: float = 40.0
+    tail: float = 15.0
+    rate: int = 44100
+    channels: int = 2
+    noise: float = 0.0
+    seed: int = 0
+
+    @property
+    def duration(self):
+        return self.intro + self.body + self.tail
+
+
+base = Case('base')
+cases = [
+    base,
+    dataclasses.replace(base, name='long', body=240.0, tail=60.0),
+    dataclasses.replace(base, name='22khz', rate=22050),
+    dataclasses.replace(base, name='mono', channels=1),
+    dataclasses.replace(base, name='noisy', noise=0.02),
+    # The loop start is capped at 47% of the track, so a long intro needs
+    # a long tail too.
+    dataclasses.replace(base, name='long-intro', intro=30.0, tail=30.0),
+]
+
+
+def notes(rng, seconds, rate, channels):
+    """Random melody of decaying sine notes, as (samples, channels)."""
+    notelen = int(0.25 * rate)
+    t = np.arange(notelen) / rate
+    envelope = np.exp(-6 * t)
+    # A pentatonic scale, so that the notes don't repeat by accident.
+    scale = 220 * 2 ** (np.array([0, 2, 4, 7, 9, 12, 14, 16]) / 12)
+    count = -(-int(seconds * rate) // notelen)
+    out = np.empty((count * notelen, channels))
+    for i in range(count):
+        freqs = rng.choice(scale, size=2)
+        note = (np.sin(2 * np.pi * freqs[0] * t) +
+                0.5 * np.sin(2 * np.pi * freqs[1] * t)) * envelope
+        pan = rng.uniform(0.3, 1.0, size=channels)
+        out[i * notelen:(i + 1) * notelen] = note[:, None] * pan
+    return out[:int(seconds * rate)] * 0.4
+
+
+def synthesize(case):
+    """PCM of case as float (samples, channels), loop start and length."""
+    rng = np.random.default_rng(case.seed)
+    intro = notes(rng, case.intro, case.rate, case.channels)
+    body = notes(rng, case.body, case.rate, case.channels)
+    tail = body[:int(case.tail * case.rate)]
+    pcm = np.concatenate([intro, body, tail])
+    if case.noise:
+        pcm += rng.normal(scale=case.noise, size=pcm.shape)
+    return pcm, len(intro), len(body)
+
+
+def encode(pcm, rate, path):
+    data = (np.clip(pcm, -1, 1) * 32767).astype('<i2').tobytes()
+    subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error',
+                    '-f', 's16le', '-ar', str(rate),
+                    '-ac', str(pcm.shape[1]), '-i', 'pipe:0',
+                    '-c:a', 'flac', str(path)],
+                   input=data, check=True)
+
+
+def timed(f, *args, **ka):
+    start = time.perf_counter()
+    result = f(*args, **ka)
+    return result, time.perf_counter() - start
+
+
+def run_case(case, opts, workdir):
+    pcm, loop_start, loop_length = synthesize(case)
+    path = os.path.join(workdir, case.name + '.flac')
+    encode(pcm, case.rate, path)
+
+    (rate, s), decode_time = timed(crosslooper.normalize_denoise, opts, path)
+    snippetlen = int(opts.loop_search_len * rate)
+    snippet = s[int(opts.loop_start_min * rate):][:snippetlen]
+    end_min = int(opts.loop_end_min * rate)
+    _, correlate_time = timed(crosslooper.corrabs, snippet, s[end_min:],
+                              dtype=opts.dtype)
+    found, search_time = timed(crosslooper.find_loop, s, rate, opts)
+
+    # Any start inside the repeated part loops correctly, as long as the
+    # length matches.
+    tail = len(pcm) - loop_start - loop_length
+    length_error = found.length - loop_length
+    ok = (abs(length_error) <= rate // 1000 and
+          loop_start <= found.start <= loop_start + tail)
+    return {
+        'case': case.name,
+        'seconds': case.duration,
+        'rate': case.rate,
+        'channels': case.channels,
+        'noise': case.noise,
+        'intro': case.intro,
+        'decode_seconds': decode_time,
+        'correlate_seconds': correlate_time,
+        'search_seconds': search_time,
+        'decode_speed': case.duration / decode_time,
+        'correlate_speed': case.duration / correlate_time,
+        'search_speed': case.duration / search_time,
+        'loop_start': int(found.start),
+        'loop_length': int(found.length),
+        'length_error_ms': length_error * 1000 / rate,
+        'ok': bool(ok),
+    }
+
+
+def main():
+    parser = crosslooper.cli_parser(in1=None, in2=None, show=None)
+    parser.description = __doc__
+    parser.set_defaults(**{'cache-size': 0})
+    parser.add_argument('--quick', action='store_true',
+                        help='Skip the long cases.')
+    parser.add_argument('--case', action='append', default=None,
+                        help='Only run the named case; may be repeated.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON.')
+    args = parser.parse_args().__dict__
+    opts = crosslooper.Options.from_ka(args)
+
+    todo = cases
+    if args['quick']:
+        todo = [c for c in todo if c.duration < 120]
+    if args['case'] is not None:
+        todo = [c for c in todo if c.name in args['case']]
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for case in todo:
+            results.append(run_case(case, opts, workdir))
+            if not args['json']:
+                r = results[-1]
+                print(f'{r["case"]:>12}  {r["seconds"]:6.0f} s  ' +
+                      f'decode {r["decode_speed"]:8.1f}x  ' +
+                      f'correlate {r["correlate_speed"]:8.1f}x  ' +
+                      f'search {r["search_speed"]:7.1f}x  ' +
+                      f'error {r["length_error_ms"]:8.2f} ms  ' +
+                      ('ok' if r['ok'] else 'WRONG'),
+                      flush=True)
+
+    if args['json']:
+        print(json.dumps(results, indent=2))
+    elif not all(r['ok'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
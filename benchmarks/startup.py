@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Measure how long the CrossLooper entry points take to import.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter a
+few times for each entry point, and reports the median cumulative import
+time along with the slowest imports of the last run.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+entry_points = ['crosslooper', 'crosslooperdir']
+
+
+def import_times(module):
+    """Import module in a new interpreter.
+
+    Returns a dict mapping each imported module to its cumulative import
+    time in microseconds, or raises RuntimeError if the import failed.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import ' + module],
+                          env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # The header line.
+            continue
+        times[fields[2].strip()] = cumulative
+    if proc.returncode:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    return times
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Imports per entry point. (default: 5)')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Slowest imports to list. (default: 10)')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    results = {}
+    for module in entry_points:
+        try:
+            runs = [import_times(module) for i in range(args.repeat)]
+        except RuntimeError as e:
+            results[module] = {'error': str(e)}
+            continue
+        slowest = sorted(runs[-1].items(), key=lambda item: item[1],
+                         reverse=True)
+        results[module] = {
+            'median_ms': statistics.median(run[module]
+                                           for run in runs) / 1000,
+            'slowest': [{'module': name, 'ms': us / 1000}
+                        for name, us in slowest[1:args.top + 1]],
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for module, result in results.items():
+        if 'error' in result:
+            print(f'{module}: failed to import: {result["error"]}')
+            continue
+        print(f'{module}: {result["median_ms"]:.1f} ms')
+        for entry in result['slowest']:
+            print(f'    {entry["ms"]:8.1f} ms  {entry["module"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,94 +1,867 @@
 #!/usr/bin/env python3
 
-import matplotlib
-from matplotlib import pyplot as plt
 import numpy as np
 from scipy import fft
-from scipy.io import wavfile
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import dataclasses
+import functools
+import heapq
+import hashlib
+import json
 import math
+import os
 import pathlib
+import re
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+# resource is Unix only; without it, no peak memory is reported.
+try:
+    import resource
+except ModuleNotFoundError:
+    resource = None
 import mutagen
 from mutagen import ogg, flac, apev2
 from tqdm import tqdm
 
-matplotlib.use('TkAgg')
-
 __version__ = "1.0.1"
 __author__ = """Splendide Imaginarius"""
 
 # Globals
 ax = None
-take = None
-normalize = False
-denoise = False
-lowpass = 0
-samples = False
-loop = True
-loopstart = 5
-loopstartmax = None
-loopendmin = 20.0
-looplenmin = 0.0
-loopsearchstep = 1.0
-loopsearchlen = 5.0
-loopforce = False
-skip = False
-verbose = False
-
-ffmpegwav = ['ffmpeg', '-i', '{infile}', '-c:a', 'pcm_s16le', '-map', '0:a', '{outfile}']
-ffmpegwavtake = ['ffmpeg', '-i', '{infile}', '-t', '{take}', '-c:a', 'pcm_s16le', '-map', '0:a', '{outfile}']
-ffmpegnormalize = ['ffmpeg', '-y', '-nostdin', '-i', '{infile}', '-filter_complex',
-                   '[0:0]loudnorm=i=-23.0:lra=7.0:tp=-2.0:offset=4.45:linear=true:print_format=json[norm0]',
-                   '-map_metadata', '0', '-map_metadata:s:a:0', '0:s:a:0',
-                   '-map_chapters', '0', '-c:v', 'copy', '-map', '[norm0]',
-                   '-c:a:0', 'pcm_s16le', '-c:s', 'copy', '{outfile}']
-ffmpegdenoise = ['ffmpeg', '-i', '{infile}', '-af', 'afftdn=nf=-25', '{outfile}']
-ffmpeglow = ['ffmpeg', '-i', '{infile}', '-af', 'lowpass=f={lowpass}', '{outfile}']
-
-
-def o(x):
-    return '%s%s' % (x, '.wav')
-
-
-def print_maybe(*s, **ka):
-    if verbose:
+
+ffmpegdecode = ['ffmpeg', '-nostdin', '-i', '{infile}', '-map', '0:a:0']
+ffmpegtake = ['-t', '{take}']
+ffmpegfilter = ['-af', '{filters}']
+ffmpegrate = ['-ar', '{rate}']
+ffmpegpipe = ['-c:a', 'pcm_s16le', '-f', 'wav', '-bitexact', 'pipe:1']
+ffmpegnormalize = 'loudnorm=i=-23.0:lra=7.0:tp=-2.0:offset=4.45:linear=true:print_format=json'
+ffmpegdenoise = 'afftdn=nf=-25'
+ffmpeglow = 'lowpass=f={lowpass}'
+
+looptags = ('LOOPSTART', 'LOOPLENGTH', 'LOOP_START', 'LOOP_END')
+
+
+@dataclasses.dataclass(frozen=True)
+class Options:
+    """Options for decoding and loop search.
+
+    The fields match the command line options of the same name (see
+    cli_parser), with memory_budget and cache_size in MiB.  Instances are
+    immutable, so one can be shared by analyses running in several
+    threads.  Unlike the command line, the cache is off and the search
+    uses one thread by default; threads=None uses all hardware threads.
+    """
+    take: str = None
+    normalize: bool = False
+    denoise: bool = False
+    lowpass: int = 0
+    preprocess: str = 'ffmpeg'
+    sample_rate: int = 0
+    channels: str = 'first'
+    loop_start_min: float = 5.0
+    loop_start_max: float = None
+    loop_end_min: float = 20.0
+    loop_len_min: float = 0.0
+    loop_search_step: float = 1.0
+    loop_search_len: float = 5.0
+    loop_search_coarse_rate: int = 0
+    loop_search_coarse_candidates: int = 8
+    loop_search_early_exit: float = 0.0
+    loop_search_features: bool = False
+    loop_search_candidates: str = 'grid'
+    loop_refine: float = 0.0
+    loop_candidates: int = 1
+    loop_candidates_separation: float = 1.0
+    single_precision: bool = False
+    threads: int = 1
+    memory_budget: int = 512
+    low_memory: bool = False
+    cache_dir: str = None
+    cache_size: int = 0
+    verbose: bool = False
+
+    @classmethod
+    def from_ka(cls, ka):
+        """Options from a dict of command line arguments."""
+        return cls(**{f.name: ka[f.name.replace('_', '-')]
+                      for f in dataclasses.fields(cls)
+                      if f.name.replace('_', '-') in ka})
+
+    @property
+    def dtype(self):
+        return np.float32 if self.single_precision else np.float64
+
+    @property
+    def cache_path(self):
+        if self.cache_dir is None:
+            return default_cache_dir()
+        return pathlib.Path(self.cache_dir)
+
+
+@dataclasses.dataclass(frozen=True)
+class LoopResult:
+    """Loop found by find_loop.
+
+    Positions are in samples.  end_min is the minimum loop end of the
+    winning candidate, which is where its correlation starts.
+    seam_error is the seam_error of the loop, or None if there is none.
+    alternatives are the next best loops, as LoopResults without
+    alternatives of their own, if loop_candidates asked for them.
+    """
+    sample_rate: int
+    start: int
+    end: int
+    end_min: int
+    confidence: float
+    normalized_confidence: float
+    seam_error: float = None
+    alternatives: tuple = ()
+
+    @property
+    def length(self):
+        return self.end - self.start
+
+    def to_json(self):
+        """The loop as a dict for JSON, without sample_rate."""
+        d = {'start': int(self.start), 'end': int(self.end),
+             'end_min': int(self.end_min),
+             'confidence': float(self.confidence),
+             'normalized_confidence': float(self.normalized_confidence),
+             'seam_error': self.seam_error}
+        if self.alternatives:
+            d['alternatives'] = [a.to_json() for a in self.alternatives]
+        return d
+
+    @classmethod
+    def from_json(cls, sample_rate, d):
+        return cls(sample_rate=sample_rate, start=d['start'], end=d['end'],
+                   end_min=d['end_min'], confidence=d['confidence'],
+                   normalized_confidence=d['normalized_confidence'],
+                   seam_error=d['seam_error'],
+                   alternatives=tuple(cls.from_json(sample_rate, a)
+                                      for a in d.get('alternatives', ())))
+
+
+class TopLoops:
+    """The k best loop candidates with clearly different lengths.
+
+    A bounded min-heap of (score, -order, start, end, end_min,
+    confidence) tuples, so that the first of equally good candidates
+    wins.  A candidate whose length is within separation samples of a
+    better one is suppressed, and suppresses any worse ones it is within
+    separation of.  Candidates suppressed by one that is later
+    suppressed itself don't come back, so this is greedy, like the rest
+    of the search.
+    """
+    def __init__(self, k, separation):
+        self.k = k
+        self.separation = separation
+        self.heap = []
+        self.count = 0
+
+    def push(self, score, start, end, end_min, confidence):
+        entry = (score, -self.count, start, end, end_min, confidence)
+        self.count += 1
+        near = [e for e in self.heap
+                if abs((e[3] - e[2]) - (end - start)) < self.separation]
+        if any(e[:2] >= entry[:2] for e in near):
+            return
+        if near:
+            self.heap = [e for e in self.heap if e not in near]
+            heapq.heapify(self.heap)
+        heapq.heappush(self.heap, entry)
+        if len(self.heap) > self.k:
+            heapq.heappop(self.heap)
+
+    def best(self):
+        """The candidates, best first."""
+        return sorted(self.heap, reverse=True)
+
+
+def peak_rss_mib():
+    """High-water mark of this process's resident memory, or None."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+class Profile:
+    """Timings of the stages of processing one file.
+
+    Each event is a dict with the stage name, its start (seconds since
+    the epoch, so that events from several processes line up) and its
+    duration.  peak_rss_mib is the process's memory high-water mark when
+    the last stage finished; a crosslooperdir worker that processed a
+    bigger file before keeps reporting that file's peak.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.peak_rss_mib = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        counter = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.events.append({'stage': name, 'start': start,
+                                'seconds': time.perf_counter() - counter})
+            self.peak_rss_mib = peak_rss_mib()
+
+    def totals(self):
+        totals = {}
+        for event in self.events:
+            totals[event['stage']] = (totals.get(event['stage'], 0.0) +
+                                      event['seconds'])
+        return totals
+
+    def summary(self):
+        return {'stages': self.totals(), 'peak_rss_mib': self.peak_rss_mib}
+
+
+def stage(profiler, name):
+    """Time a stage with profiler, if there is one."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+
+def profile_report(profiles, fmt='json'):
+    """Combine the profiles of several files into a JSON-able report.
+
+    profiles is a list of dicts with the file name, the number of the
+    process that handled it, and its Profile's summary and events.  fmt
+    is 'json' for per-file and total stage times, or 'chrome' for the
+    Chrome trace event format (for chrome://tracing or Perfetto).
+    """
+    if fmt == 'chrome':
+        events = []
+        for profile in profiles:
+            for event in profile['events']:
+                events.append({'name': event['stage'], 'cat': 'crosslooper',
+                               'ph': 'X', 'pid': 0,
+                               'tid': profile['process'],
+                               'ts': event['start'] * 1e6,
+                               'dur': event['seconds'] * 1e6,
+                               'args': {'file': profile['file']}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    totals = {}
+    for profile in profiles:
+        for name, seconds in profile['stages'].items():
+            totals[name] = totals.get(name, 0.0) + seconds
+    peaks = [profile['peak_rss_mib'] for profile in profiles
+             if profile['peak_rss_mib'] is not None]
+    return {'stages': totals,
+            'peak_rss_mib': max(peaks) if peaks else None,
+            'files': [{'file': profile['file'],
+                       'stages': profile['stages'],
+                       'peak_rss_mib': profile['peak_rss_mib']}
+                      for profile in profiles]}
+
+
+def write_profile(path, fmt, profiles):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(profile_report(profiles, fmt), f, indent=1)
+
+
+def print_maybe(opts, *s, **ka):
+    if opts.verbose:
         print(*s, **ka)
 
 
-def in_out(command, infile, outfile):
+def format_command(opts, command, infile, filters=''):
+    return list([token.format(infile=infile, take=opts.take,
+                              filters=filters, rate=opts.sample_rate)
+                 for token in command])
+
+
+def in_out(opts, command, infile, filters='', out=None):
     hdr = '-'*len(command)
-    print_maybe("%s\n%s\n%s" % (hdr, command, hdr))
-    command = list([token.format(infile=infile, outfile=outfile, take=take, lowpass=lowpass) for token in command])
-    subprocess.run(command,
-                   stdout=(None if verbose else subprocess.DEVNULL),
-                   stderr=(None if verbose else subprocess.DEVNULL),
-                   check=True)
-
-
-def normalize_denoise(infile, outname, allow_take=True):
-    with tempfile.TemporaryDirectory() as tempdir:
-        outfile = o(pathlib.Path(tempdir)/outname)
-        in_out(ffmpegwav if (take is None or not allow_take) else ffmpegwavtake, infile, outfile)
-        if normalize:
-            infile, outfile = outfile, o(outfile)
-            in_out(ffmpegnormalize, infile, outfile)
-        if denoise:
-            infile, outfile = outfile, o(outfile)
-            in_out(ffmpegdenoise, infile, outfile)
-            infile, outfile = outfile, o(outfile)
-            in_out(ffmpegdenoise, infile, outfile)
-        if int(lowpass):
-            infile, outfile = outfile, o(outfile)
-            in_out(ffmpeglow, infile, outfile)
-        r, s = wavfile.read(outfile)
-        # Check if stereo
-        if len(s.shape) > 1:
-            s = s[:, 0]
+    print_maybe(opts, "%s\n%s\n%s" % (hdr, command, hdr))
+    command = format_command(opts, command, infile, filters)
+    proc = subprocess.Popen(command,
+                            stdout=subprocess.PIPE,
+                            stderr=(None if opts.verbose
+                                    else subprocess.DEVNULL))
+    # Read into a bytearray so the samples end up in a writable buffer
+    # without another copy, or stream to out if given.
+    data = bytearray() if out is None else out
+    while True:
+        chunk = proc.stdout.read(1 << 20)
+        if not chunk:
+            break
+        if out is None:
+            data += chunk
+        else:
+            out.write(chunk)
+    proc.stdout.close()
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, command)
+    return data
+
+
+def wav_pipe_header(data):
+    """Parse the header of a WAV stream written by ffmpeg to a pipe.
+
+    Returns the channel count, sample rate and offset of the samples.
+    ffmpeg can't seek back to fill in the chunk sizes when writing to a
+    pipe, so the data chunk is assumed to run to the end of the stream.
+    """
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise ValueError('ffmpeg did not output a WAV stream')
+    pos = 12
+    channels = rate = None
+    while pos + 8 <= len(data):
+        chunk_id = bytes(data[pos:pos + 4])
+        chunk_size, = struct.unpack('<I', data[pos + 4:pos + 8])
+        pos += 8
+        if chunk_id == b'fmt ':
+            channels, rate = struct.unpack('<HI', data[pos + 2:pos + 8])
+        elif chunk_id == b'data':
+            break
+        pos += chunk_size + (chunk_size & 1)
+    else:
+        raise ValueError('WAV stream has no data chunk')
+    if channels is None:
+        raise ValueError('WAV stream has no fmt chunk')
+    return channels, rate, pos
+
+
+def wav_pipe_read(data):
+    """Parse a WAV stream written by ffmpeg to a pipe."""
+    channels, rate, pos = wav_pipe_header(data)
+    count = (len(data) - pos) // (2 * channels) * channels
+    s = np.frombuffer(data, dtype='<i2', count=count, offset=pos)
+    return rate, s.reshape(-1, channels)
+
+
+def wav_pipe_map(f):
+    """Like wav_pipe_read, but memory-maps the stream saved in file f."""
+    f.seek(0)
+    channels, rate, pos = wav_pipe_header(f.read(1 << 16))
+    count = (os.fstat(f.fileno()).st_size - pos) // (2 * channels)
+    s = np.memmap(f, dtype='<i2', mode='r', offset=pos,
+                  shape=(count, channels))
+    return rate, s
+
+
+def temp_array(opts, shape, dtype):
+    """Scratch array backed by an anonymous temporary file.
+
+    The OS can page it out instead of swapping, and the file goes away
+    once the array is garbage collected.
+    """
+    return np.memmap(tempfile.TemporaryFile(dir=tempdir(opts)), dtype=dtype,
+                     mode='w+', shape=shape)
+
+
+def tempdir(opts):
+    # Prefer the cache dir, which is more likely to be on a real disk than
+    # the system temp dir (often a tmpfs, which lives in memory anyway).
+    if opts.cache_size:
+        try:
+            opts.cache_path.mkdir(parents=True, exist_ok=True)
+            return opts.cache_path
+        except OSError:
+            pass
+    return None
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join('~', '.cache')
+    return pathlib.Path(base).expanduser() / 'crosslooper'
+
+
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache(maxsize=64)
+def _file_hash(path, size, mtime_ns):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_hash(opts, path, follow_alias=True):
+    """Hash of the contents of path.
+
+    Writing loop tags changes the file but not its audio, so by default
+    this follows the alias recorded by save_tags back to the hash the file
+    had before we tagged it.
+    """
+    st = os.stat(path)
+    h = _file_hash(str(path), st.st_size, st.st_mtime_ns)
+    if follow_alias:
+        alias = cache_load_json(opts, cache_key('alias', h))
+        if alias is not None:
+            h = alias['hash']
+    return h
+
+
+def decode_key(opts, infile, allow_take=True):
+    """Cache key for the decoded, preprocessed PCM of infile."""
+    filtered = opts.normalize or opts.denoise or int(opts.lowpass)
+    return cache_key('pcm', file_hash(opts, infile),
+                     ffmpegdecode + ffmpegpipe,
+                     ffmpegnormalize if opts.normalize else None,
+                     ffmpegdenoise if opts.denoise else None,
+                     str(opts.lowpass) if int(opts.lowpass) else None,
+                     opts.preprocess if filtered else None,
+                     str(opts.sample_rate) if opts.sample_rate else None,
+                     opts.channels,
+                     str(opts.take) if opts.take is not None and allow_take
+                     else None)
+
+
+def cache_touch(path):
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+# Names of the files that cache_write makes, and the only ones that
+# cache_evict ever deletes.
+cache_entry_name = re.compile(r'[0-9a-f]{64}\.(json|npy)')
+
+
+def cache_entries(opts):
+    """Directory of the cache entries.
+
+    A subdirectory of cache_path, so that other files in --cache-dir
+    aren't mixed up with them.
+    """
+    return opts.cache_path / 'entries'
+
+
+def cache_evict(opts):
+    """Delete cache entries until they fit in cache_size.
+
+    Arrays (PCM, spectra and features) go first, least recently used
+    first, and only then JSON entries, so that the small loop search
+    results outlive the bulky arrays they were computed from.
+    """
+    entries = []
+    try:
+        paths = list(cache_entries(opts).iterdir())
+    except OSError:
+        return
+    for p in paths:
+        if not cache_entry_name.fullmatch(p.name):
+            continue
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        entries.append((p.suffix != '.npy', st.st_mtime, st.st_size, p))
+    total = sum(size for json_entry, mtime, size, p in entries)
+    for json_entry, mtime, size, p in sorted(entries):
+        if total <= opts.cache_size * 1024 * 1024:
+            break
+        try:
+            p.unlink()
+        except OSError:
+            continue
+        total -= size
+
+
+def cache_write(opts, key, suffix, write):
+    if not opts.cache_size or key is None:
+        return
+    cachedir = cache_entries(opts)
+    try:
+        cachedir.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        print_maybe(opts, 'Failed to create cache directory', cachedir)
+        return
+    path = cachedir / (key + suffix)
+    # Write under a unique name and rename, so concurrent crosslooperdir
+    # workers and threads never see a partial entry.
+    tmp = cachedir / ('%s.%d.%d.tmp' % (key, os.getpid(),
+                                        threading.get_ident()))
+    try:
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except OSError:
+        print_maybe(opts, 'Failed to write cache entry', path)
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        return
+    cache_evict(opts)
+
+
+def cache_load_json(opts, key):
+    if not opts.cache_size or key is None:
+        return None
+    path = cache_entries(opts) / (key + '.json')
+    if not cache_touch(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def cache_save_json(opts, key, data):
+    cache_write(opts, key, '.json',
+                lambda f: f.write(json.dumps(data).encode('utf-8')))
+
+
+def cache_load_array(opts, key):
+    if not opts.cache_size or key is None:
+        return None
+    path = cache_entries(opts) / (key + '.npy')
+    if not cache_touch(path):
+        return None
+    try:
+        return np.load(path, mmap_mode='r' if opts.low_memory else None)
+    except (OSError, ValueError):
+        return None
+
+
+def cache_save_array(opts, key, array):
+    cache_write(opts, key, '.npy', lambda f: np.save(f, array))
+
+
+def open_tags(path, mf=None):
+    """Open the tags of path; mf may be an already opened mutagen.File."""
+    if mf is None:
+        mf = mutagen.File(path)
+    if not isinstance(mf, (ogg.OggFileType, flac.FLAC)):
+        # Not a Vorbis Comment file; fallback to APEv2
+        mf = apev2.APEv2File(path)
+    return mf
+
+
+def read_loop_tags(path, mf=None):
+    """The loop tags of path, as a dict of lists of strings.
+
+    mf may be an already opened mutagen.File.  The result works with
+    loop_tags_present, and is all file_offset needs to know about the
+    existing tags, so callers that already read it can pass it on.
+    """
+    mf = open_tags(path, mf)
+    return {name: list(mf[name]) for name in looptags if name in mf}
+
+
+def loop_tags_present(mf, loopseconds):
+    # Check for samples-denominated tags.
+    if 'LOOPSTART' in mf and 'LOOPLENGTH' in mf:
+        # Check for seconds-denominated tags.
+        if not loopseconds or ('LOOP_START' in mf and 'LOOP_END' in mf):
+            return True
+    return False
+
+
+def save_tags(opts, mf, path, content_hash=None):
+    mf.save()
+    if content_hash is not None:
+        cache_save_json(opts, cache_key('alias', file_hash(opts, path, False)),
+                        {'hash': content_hash})
+
+
+def write_tags(opts, path, tags, content_hash=None):
+    """Set all of tags (a dict of strings) on path with a single save."""
+    mf = open_tags(path)
+    for name, value in tags.items():
+        mf[name] = [value]
+    save_tags(opts, mf, path, content_hash)
+
+
+def file_sample_rate(path):
+    """Sample rate in the header of path, or None if mutagen can't tell."""
+    try:
+        return mutagen.File(path).info.sample_rate
+    except (mutagen.MutagenError, OSError, AttributeError):
+        return None
+
+
+def channel_mix(opts, s):
+    """Turn decoded (samples, channels) PCM into the signal to correlate."""
+    if opts.channels == 'first' or s.shape[1] == 1:
+        return np.ascontiguousarray(s[:, 0])
+    if opts.channels == 'mono':
+        return s.mean(axis=1, dtype=np.float32)
+    if opts.channels == 'side':
+        return np.subtract(s[:, 0], s[:, 1], dtype=np.float32) / 2
+    # 'all': correlated per channel, see channel_sum.
+    return s
+
+
+def channel_mix_mapped(opts, s, chunk=1 << 20):
+    """channel_mix for memory-mapped PCM, without loading all of it."""
+    if opts.channels == 'first' or s.shape[1] == 1:
+        return s[:, 0]
+    if opts.channels == 'all':
+        return s
+    out = temp_array(opts, len(s), np.float32)
+    for b in range(0, len(s), chunk):
+        out[b:b + chunk] = channel_mix(opts, s[b:b + chunk])
+    return out
+
+
+def loudness_gain(s, rate, target=-23.0, chunk=1 << 20):
+    """Gain that brings s to target dB below full scale.
+
+    A stand-in for ffmpeg's loudnorm: the level is the mean power of the
+    400 ms blocks that pass the ITU-R BS.1770 gates (-70 dB absolute, and
+    10 dB below the mean of those), summed over channels, without the
+    K-weighting filter.
+    """
+    blocklen = int(0.4 * rate)
+    chunk -= chunk % blocklen
+    powers = []
+    for b in range(0, len(s) - blocklen + 1, chunk):
+        part = np.asarray(s[b:b + chunk], dtype=np.float64) / 32768
+        part = part[:len(part) - len(part) % blocklen]
+        part = part.reshape((-1, blocklen) + part.shape[1:])
+        power = np.square(part).mean(axis=1)
+        powers.append(power.sum(axis=1) if power.ndim > 1 else power)
+    if not powers:
+        return 1.0
+    powers = np.concatenate(powers)
+    powers = powers[powers > 10 ** (-70 / 10)]
+    if not len(powers):
+        return 1.0
+    powers = powers[powers > powers.mean() * 10 ** (-10 / 10)]
+    return 10 ** ((target - 10 * math.log10(powers.mean())) / 20)
+
+
+def spectral_gate(x, nfft=2048, reduction=-12.0, chunk_frames=256):
+    """Denoise the 1-D float array x in place by spectral gating.
+
+    A stand-in for one pass of ffmpeg's afftdn, which reduces noise by
+    12 dB by default: each bin of a short-time spectrum that isn't well
+    above that bin's noise floor is attenuated by reduction dB.  Frames
+    overlap by half with a square root Hann window, so the output is x
+    itself where nothing is gated.
+    """
+    from scipy import signal
+
+    n = len(x)
+    hop = nfft // 2
+    window = np.sqrt(signal.get_window('hann', nfft)).astype(np.float32)
+    if n < nfft:
+        return
+    # Noise floor of each bin: its mean magnitude in the quietest tenth
+    # of a sample of frames.
+    starts = np.linspace(0, n - nfft, min(256, (n - nfft) // hop + 1),
+                         dtype=int)
+    sample = np.stack([x[b:b + nfft] for b in starts]) * window
+    quietest = np.argsort(np.square(sample).sum(axis=1))
+    quietest = quietest[:max(1, len(quietest) // 10)]
+    noise = np.abs(fft.rfft(sample[quietest], axis=1)).mean(axis=0)
+    # Noise magnitudes are Rayleigh distributed, so the bins above 4 times
+    # their mean hold less than 0.01% of the noise energy.
+    threshold = 4 * noise
+    attenuation = np.float32(10 ** (reduction / 20))
+
+    # Frame k covers x[(k - 1) * hop:(k + 1) * hop], so segment j of the
+    # output is the first half of frame j plus the second half of frame
+    # j - 1.  Each chunk of frames only reads segments it hasn't written.
+    frames = -(-n // hop) + 1
+    carry = np.zeros(hop, dtype=np.float32)
+    for a in range(0, frames, chunk_frames):
+        b = min(a + chunk_frames, frames)
+        inp = np.zeros((b - a + 1) * hop, dtype=np.float32)
+        lo = max(0, (a - 1) * hop)
+        hi = min(n, b * hop)
+        inp[lo - (a - 1) * hop:hi - (a - 1) * hop] = x[lo:hi]
+        spec = fft.rfft(np.lib.stride_tricks.sliding_window_view(
+                            inp, nfft)[::hop] * window, axis=1)
+        spec[np.abs(spec) < threshold] *= attenuation
+        out = fft.irfft(spec, nfft, axis=1).astype(np.float32) * window
+        y = out[:, :hop].copy()
+        y[0] += carry
+        y[1:] += out[:-1, hop:]
+        carry = out[-1, hop:]
+        y = y.ravel()
+        # Segment 0 is the padding before x.
+        lo = max(0, (a - 1) * hop)
+        hi = min(n, (b - 1) * hop)
+        x[lo:hi] = y[lo - (a - 1) * hop:hi - (a - 1) * hop]
+
+
+def lowpass_filter(x, rate, cutoff, chunk=1 << 20):
+    """Low pass filter the 1-D float array x in place.
+
+    A stand-in for ffmpeg's lowpass: a second order Butterworth filter,
+    run chunk by chunk with its state carried over.
+    """
+    from scipy import signal
+
+    if not 0 < cutoff < rate / 2:
+        return
+    sos = signal.butter(2, cutoff, fs=rate, output='sos')
+    zi = np.zeros((sos.shape[0], 2))
+    for b in range(0, len(x), chunk):
+        x[b:b + chunk], zi = signal.sosfilt(sos, x[b:b + chunk], zi=zi)
+
+
+def native_preprocess(opts, rate, s, chunk=1 << 20):
+    """Apply --normalize, --denoise and --lowpass to decoded PCM.
+
+    These approximate the ffmpeg filters closely enough for correlating,
+    without another ffmpeg pass.  s is copied to float32 once, and then
+    filtered in place.
+    """
+    if opts.low_memory:
+        out = temp_array(opts, s.shape, np.float32)
+    else:
+        out = np.empty(s.shape, dtype=np.float32)
+    for b in range(0, len(s), chunk):
+        out[b:b + chunk] = s[b:b + chunk]
+    if opts.normalize:
+        gain = np.float32(loudness_gain(out, rate))
+        for b in range(0, len(out), chunk):
+            out[b:b + chunk] *= gain
+    for x in ([out] if out.ndim == 1 else out.T):
+        if opts.denoise:
+            # Twice, like the ffmpeg filters.
+            spectral_gate(x)
+            spectral_gate(x)
+        if int(opts.lowpass):
+            lowpass_filter(x, rate, int(opts.lowpass))
+    return out
+
+
+def decode_options(opts):
+    """The options that ffmpeg decodes with for opts.
+
+    With --preprocess native, ffmpeg only decodes, and the filters are
+    applied afterwards.
+    """
+    if opts.preprocess == 'native' and (opts.normalize or opts.denoise or
+                                        int(opts.lowpass)):
+        return dataclasses.replace(opts, normalize=False, denoise=False,
+                                   lowpass=0)
+    return opts
+
+
+def decode_command(opts, allow_take=True):
+    """The ffmpeg command that decodes with opts, and its filters.
+
+    The command's tokens still need format_command.
+    """
+    command = list(ffmpegdecode)
+    if opts.take is not None and allow_take:
+        command += ffmpegtake
+    filters = []
+    if opts.normalize:
+        filters.append(ffmpegnormalize)
+    if opts.denoise:
+        filters += [ffmpegdenoise, ffmpegdenoise]
+    if int(opts.lowpass):
+        filters.append(ffmpeglow.format(lowpass=opts.lowpass))
+    if filters:
+        command += ffmpegfilter
+    if opts.sample_rate:
+        command += ffmpegrate
+    command += ffmpegpipe
+    return command, ','.join(filters)
+
+
+def pcm_cached(opts, infile, allow_take=True):
+    """Whether normalize_denoise can load infile from the cache."""
+    if not opts.cache_size:
+        return False
+
+    def cached(o):
+        # cache_evict removes arrays before JSON, so the meta can outlive
+        # its PCM.
+        key = decode_key(o, infile, allow_take)
+        return (cache_load_json(opts, key) is not None and
+                (cache_entries(opts) / (key + '.npy')).is_file())
+
+    return any(cached(o) for o in (opts, decode_options(opts)))
+
+
+def normalize_denoise(opts, infile, allow_take=True, profiler=None,
+                      decoded=None):
+    """Decode and preprocess infile, or load it from the cache.
+
+    Returns the sample rate and the samples.  decoded is the WAV stream
+    that ffmpeg already wrote with the decode_command of
+    decode_options(opts), to use instead of running ffmpeg again.
+    """
+    key = decode_key(opts, infile, allow_take) if opts.cache_size else None
+    with stage(profiler, 'cache'):
+        meta = cache_load_json(opts, key)
+        s = None if meta is None else cache_load_array(opts, key)
+    if s is not None:
+        print_maybe(opts, 'Using cached PCM for', infile)
+        return meta['rate'], s
+
+    if decode_options(opts) is not opts:
+        # Decode (or load from the cache) without filters, and filter
+        # here.
+        r, s = normalize_denoise(decode_options(opts), infile, allow_take,
+                                 profiler, decoded)
+        with stage(profiler, 'preprocess'):
+            s = native_preprocess(opts, r, s)
+        with stage(profiler, 'cache'):
+            cache_save_array(opts, key, s)
+            cache_save_json(opts, key, {'rate': r})
         return r, s
 
+    command, filters = decode_command(opts, allow_take)
+    if decoded is not None:
+        with stage(profiler, 'preprocess'):
+            r, s = wav_pipe_read(decoded)
+            s = channel_mix(opts, s)
+    elif opts.low_memory:
+        with stage(profiler, 'decode'):
+            data = in_out(opts, command, infile, filters,
+                          tempfile.TemporaryFile(dir=tempdir(opts)))
+        with stage(profiler, 'preprocess'):
+            r, s = wav_pipe_map(data)
+            s = channel_mix_mapped(opts, s)
+    else:
+        with stage(profiler, 'decode'):
+            data = in_out(opts, command, infile, filters)
+        with stage(profiler, 'preprocess'):
+            r, s = wav_pipe_read(data)
+            s = channel_mix(opts, s)
+    with stage(profiler, 'cache'):
+        cache_save_array(opts, key, s)
+        cache_save_json(opts, key, {'rate': r})
+    return r, s
+
+
+def pyplot():
+    """Import pyplot on first use.
+
+    Only --show plots anything, and matplotlib is slow to import and
+    needs Tk, which headless machines may not have.
+    """
+    import matplotlib
+    matplotlib.use('TkAgg')
+    from matplotlib import pyplot as plt
+    return plt
+
 
 def fig1(title=None):
+    plt = pyplot()
     fig = plt.figure(1)
     plt.margins(0, 0.1)
     plt.grid(True, color='0.7', linestyle='-', which='major', axis='both')
@@ -102,6 +875,7 @@ def fig1(title=None):
 
 
 def show1(fs, s, color=None, title=None, v=None):
+    plt = pyplot()
     if not color:
         fig1(title)
     if ax and v:
@@ -112,44 +886,974 @@ def show1(fs, s, color=None, title=None, v=None):
 
 
 def show2(fs, s1, s2, title=None):
+    plt = pyplot()
     fig1(title)
     show1(fs, s1, 'blue')
     show1(fs, s2, 'red')
     plt.show()
 
 
-def read_normalized(in1, in2):
-    global normalize
-    r1, s1 = normalize_denoise(in1, 'out1')
-    if in1 == in2:
+def show_loops(fs, s, loops, title=None):
+    """Plot s with the span of each of loops, numbered from the best."""
+    plt = pyplot()
+    fig1(title)
+    show1(fs, s[:, 0] if s.ndim > 1 else s, 'black')
+    for i, found in enumerate(loops):
+        color = plt.cm.tab10(i % 10)
+        ax.axvspan(found.start / fs, found.end / fs, color=color, alpha=0.2)
+        ax.axvline(x=found.start / fs, color=color)
+        ax.axvline(x=found.end / fs, color=color, linestyle='--')
+        ax.text(found.start / fs, 1 - 0.05 * (i + 1), f' #{i + 1}',
+                color=color, transform=ax.get_xaxis_transform())
+    plt.show()
+
+
+def same_file(in1, in2):
+    """Whether in1 and in2 are the same file, however they're spelled."""
+    try:
+        return os.path.samefile(in1, in2)
+    except OSError:
+        return in1 == in2
+
+
+def resample(opts, s, rate, target, chunk=1 << 20):
+    """Resample decoded PCM from rate to target, keeping its dtype."""
+    from scipy import signal
+
+    g = math.gcd(rate, target)
+    resampled = signal.resample_poly(s, target // g, rate // g, axis=0)
+    if np.issubdtype(s.dtype, np.integer):
+        info = np.iinfo(s.dtype)
+        np.rint(resampled, out=resampled)
+        np.clip(resampled, info.min, info.max, out=resampled)
+    if opts.low_memory:
+        out = temp_array(opts, resampled.shape, s.dtype)
+    else:
+        out = np.empty(resampled.shape, dtype=s.dtype)
+    for b in range(0, len(out), chunk):
+        out[b:b + chunk] = resampled[b:b + chunk]
+    return out
+
+
+def read_normalized(opts, in1, in2, profiler=None, decoded=None):
+    """Decode in1 and in2 at a common sample rate.
+
+    Each file is decoded once: if in2 is in1, they share a buffer, and if
+    their rates differ, the lower rate one is resampled to the higher
+    rate.  decoded is passed on to normalize_denoise for in1.
+    """
+    r1, s1 = normalize_denoise(opts, in1, profiler=profiler,
+                               decoded=decoded)
+    if same_file(in1, in2):
         r2, s2 = r1, s1
     else:
-        r2, s2 = normalize_denoise(in2, 'out2')
+        r2, s2 = normalize_denoise(opts, in2, profiler=profiler)
     if r1 != r2:
-        old, normalize = normalize, True
-        r1, s1 = normalize_denoise(in1, 'out1')
-        r2, s2 = normalize_denoise(in2, 'out2')
-        normalize = old
-    assert r1 == r2, "not same sample rate"
+        print_maybe(opts, 'Resampling from', min(r1, r2), 'to',
+                    max(r1, r2))
+        with stage(profiler, 'preprocess'):
+            if r1 < r2:
+                r1, s1 = r2, resample(opts, s1, r1, r2)
+            else:
+                r2, s2 = r1, resample(opts, s2, r2, r1)
     fs = r1
     return fs, s1, s2
 
 
-def corrabs(s1, s2):
+def channel_sum(spec, ndim=1):
+    """Sum cross-spectra over channels.
+
+    Signals are either ndim-dimensional or have a trailing channel axis.
+    Correlations of the channels add up linearly, so summing the
+    cross-spectra lets a single inverse FFT cover all channels.
+    """
+    return spec.sum(axis=-1) if spec.ndim > ndim else spec
+
+
+def corrabs(s1, s2, workers=None, dtype=np.float64):
     ls1 = len(s1)
     ls2 = len(s2)
-    padsize = ls1+ls2+1
-    padsize = 2**(int(np.log(padsize)/np.log(2))+1)
-    s1pad = np.zeros(padsize)
-    s1pad[:ls1] = s1
-    s2pad = np.zeros(padsize)
-    s2pad[:ls2] = s2
-    corr = fft.ifft(fft.fft(s1pad)*np.conj(fft.fft(s2pad)))
+    # Any size above ls1+ls2 avoids circular wraparound, so pick one that
+    # the real FFT handles quickly instead of the next power of two.
+    padsize = fft.next_fast_len(ls1+ls2+1, real=True)
+    s1 = np.asarray(s1, dtype=dtype)
+    s2 = np.asarray(s2, dtype=dtype)
+    corr = fft.irfft(channel_sum(
+                         fft.rfft(s1, padsize, axis=0, workers=workers) *
+                         np.conj(fft.rfft(s2, padsize, axis=0,
+                                          workers=workers))),
+                     padsize, workers=workers)
     ca = np.absolute(corr)
     xmax = np.argmax(ca)
     return ls1, ls2, padsize, xmax, ca
 
 
+@contextlib.contextmanager
+def search_threads(opts, spare=None):
+    """Number of threads to use for one step of the loop search.
+
+    On top of opts.threads, as many threads as are available are borrowed
+    from the semaphore spare (see crosslooperdir) until the step is done.
+    """
+    threads = opts.threads or os.cpu_count() or 1
+    borrowed = 0
+    if spare is not None:
+        while (threads + borrowed < (os.cpu_count() or 1) and
+               spare.acquire(False)):
+            borrowed += 1
+    try:
+        yield threads + borrowed
+    finally:
+        for i in range(borrowed):
+            spare.release()
+
+
+def split_map(pool, threads, f, count):
+    """Call f(lo, hi) on up to threads even slices of range(count).
+
+    The slices run in parallel on pool, which is fine for anything that
+    spends its time in NumPy or SciPy with the GIL released.  Returns the
+    results in order.
+    """
+    bounds = [(int(c[0]), int(c[-1]) + 1)
+              for c in np.array_split(np.arange(count),
+                                      max(1, min(threads, count)))
+              if len(c)]
+    if pool is None or len(bounds) <= 1:
+        return [f(lo, hi) for lo, hi in bounds]
+    return list(pool.map(lambda bound: f(*bound), bounds))
+
+
+def loop_spectra(opts, s, snippetlen, workers=None, dtype=np.float64,
+                 pool=None, threads=1):
+    """Precompute overlap-save block spectra of s.
+
+    The blocks are shared by every loop candidate, so the track is only
+    transformed once per file instead of once per search step.  The
+    blocks are split between threads threads of pool.
+    """
+    blocklen = fft.next_fast_len(4 * snippetlen, real=True)
+    blockstep = blocklen - snippetlen + 1
+    shape = (-(-len(s) // blockstep), blocklen // 2 + 1) + s.shape[1:]
+    spectype = np.result_type(dtype, np.complex64)
+    if opts.low_memory:
+        spectra = temp_array(opts, shape, spectype)
+    else:
+        spectra = np.empty(shape, dtype=spectype)
+
+    def transform(lo, hi):
+        for i in range(lo, hi):
+            b = i * blockstep
+            spectra[i] = fft.rfft(np.asarray(s[b:b + blocklen], dtype=dtype),
+                                  blocklen, axis=0, workers=workers)
+    split_map(pool, threads, transform, shape[0])
+    return blocklen, blockstep, dtype, spectra
+
+
+def loop_spectra_cached(opts, pcm_key, s, snippetlen, workers=None,
+                        dtype=np.float64, pool=None, threads=1):
+    key = None
+    if pcm_key is not None:
+        key = cache_key('spectra', pcm_key, snippetlen, np.dtype(dtype).name)
+    spectra = cache_load_array(opts, key)
+    blocklen = fft.next_fast_len(4 * snippetlen, real=True)
+    if spectra is not None and spectra.shape[1] == blocklen // 2 + 1:
+        print_maybe(opts, 'Using cached spectra')
+        return blocklen, blocklen - snippetlen + 1, dtype, spectra
+    spectra = loop_spectra(opts, s, snippetlen, workers, dtype, pool,
+                           threads)
+    cache_save_array(opts, key, spectra[3])
+    return spectra
+
+
+def loop_batch_size(opts, spectra, snippetlen, nchannels=1):
+    """Number of loop candidates to correlate at once in loop_corrabs."""
+    blocklen, blockstep, dtype, blocks = spectra
+    headlen = fft.next_fast_len(blockstep + 3 * (snippetlen - 1), real=True)
+    # Head segments, their spectra and correlations, plus the snippet
+    # spectra and correlations for the shared blocks.
+    row = (headlen * (4 * nchannels + 1) + blocklen * (2 * nchannels + 1))
+    row *= np.dtype(dtype).itemsize
+    return max(1, int(opts.memory_budget * 1024 * 1024 // row))
+
+
+def loop_corrabs(spectra, s1, s2, starts, tail_starts, snippetlen,
+                 workers=None):
+    """Correlate a batch of loop candidates using shared spectra.
+
+    Candidate i correlates the snippet s1[starts[i]:][:snippetlen] against
+    s2[tail_starts[i]:].  This is equivalent to picking the peak of
+    corrabs(snippet, s2[tail_start:]) for each of them, but only the part
+    of the track that isn't covered by the precomputed blocks is
+    transformed again, and all candidates share each FFT call.
+
+    Returns arrays of the peak confidence and loop end of each candidate.
+    The end is -1 where corrabs would have placed the peak at a
+    non-positive lag (which file_offset treats as an invalid candidate).
+    """
+    blocklen, blockstep, dtype, blocks = spectra
+    ls2 = len(s2)
+    tail_starts = np.asarray(tail_starts)
+    rows = len(tail_starts)
+    channel_shape = s2.shape[1:]
+
+    # Shorter snippets at the end of s1 are zero-padded; zeros don't change
+    # any correlation values.
+    snippets = np.zeros((rows, snippetlen) + channel_shape, dtype=dtype)
+    for i, start in enumerate(starts):
+        snippet = s1[start:][:snippetlen]
+        snippets[i, :len(snippet)] = snippet
+
+    # Heads: lags from the snippet hanging off the start of the tail up to
+    # the first shared block.  Samples before the tail start are masked
+    # out, like the zero padding in corrabs.
+    first_blocks = -(-(tail_starts + 1) // blockstep)
+    head_starts = tail_starts - (snippetlen - 1)
+    head_counts = np.minimum(first_blocks * blockstep, ls2) - head_starts
+    # Use the largest possible head length rather than this batch's, so
+    # every batch reuses the same FFT plan and buffer sizes.
+    headout = max(blockstep + snippetlen - 1, snippetlen + 1)
+    headlen = fft.next_fast_len(headout + snippetlen - 1, real=True)
+    heads = np.zeros((rows, headout + snippetlen - 1) + channel_shape,
+                     dtype=dtype)
+    for i, tail_start in enumerate(tail_starts):
+        tail = s2[tail_start:tail_start + head_counts[i]]
+        heads[i, snippetlen - 1:][:len(tail)] = tail
+    ca = np.absolute(fft.irfft(channel_sum(
+                                   fft.rfft(heads, headlen, axis=1,
+                                            workers=workers) *
+                                   np.conj(fft.rfft(snippets, headlen,
+                                                    axis=1,
+                                                    workers=workers)),
+                                   2),
+                               headlen, axis=1, workers=workers)
+                     [:, :headout])
+    del heads
+    ca[np.arange(headout) >= head_counts[:, None]] = -1
+
+    # The peak at lag 0 and the partial-overlap lags come first in the
+    # corrabs output, so they win ties against the tail.
+    invalid_max = ca[:, :snippetlen].max(axis=1)
+    # corrabs stores the tail lags in reverse, so the last maximum wins.
+    valid = ca[:, :snippetlen - 1:-1]
+    i = np.argmax(valid, axis=1)
+    best_ca = valid[np.arange(rows), i]
+    best_end = head_starts + headout - 1 - i
+    best_ca[best_end <= tail_starts] = -np.inf
+    del ca, valid
+
+    if first_blocks.min() < len(blocks):
+        snippetspec = np.conj(fft.rfft(snippets, blocklen, axis=1,
+                                       workers=workers))
+    for b in range(int(first_blocks.min()), len(blocks)):
+        active = np.nonzero(first_blocks <= b)[0]
+        block_start = b * blockstep
+        count = min(blockstep, ls2 - block_start)
+        ca = np.absolute(fft.irfft(channel_sum(blocks[b] *
+                                               snippetspec[active], 2),
+                                   blocklen, axis=1, workers=workers)
+                         [:, count - 1::-1])
+        i = np.argmax(ca, axis=1)
+        this_ca = ca[np.arange(len(active)), i]
+        better = this_ca >= best_ca[active]
+        best_ca[active[better]] = this_ca[better]
+        best_end[active[better]] = block_start + count - 1 - i[better]
+
+    best_end[(invalid_max >= best_ca) | (tail_starts >= ls2)] = -1
+    return best_ca, best_end
+
+
+def parallel_loop_corrabs(pool, threads, spectra, s1, s2, starts,
+                          tail_starts, snippetlen):
+    """loop_corrabs, with the candidates split between threads threads.
+
+    Each candidate's result doesn't depend on the others in its batch, so
+    this gives exactly the same results as a single call.
+    """
+    parts = split_map(pool, threads,
+                      lambda lo, hi: loop_corrabs(spectra, s1, s2,
+                                                  starts[lo:hi],
+                                                  tail_starts[lo:hi],
+                                                  snippetlen),
+                      len(tail_starts))
+    return (np.concatenate([cas for cas, ends in parts]),
+            np.concatenate([ends for cas, ends in parts]))
+
+
+def window_corrabs(s1, s2, lo, hi, workers=None, dtype=np.float64):
+    """Peak of the correlation of snippet s1 against s2 at positions lo..hi-1.
+
+    Returns (confidence, position), with the same values and tie-breaking
+    loop_corrabs would give for those positions, or None if the window is
+    empty.
+    """
+    lo = max(lo, 0)
+    hi = min(hi, len(s2))
+    ls1 = len(s1)
+    if ls1 == 0 or hi <= lo:
+        return None
+    padsize = fft.next_fast_len(hi - lo + ls1 - 1, real=True)
+    seg = np.asarray(s2[lo:hi + ls1 - 1], dtype=dtype)
+    s1 = np.asarray(s1, dtype=dtype)
+    ca = np.absolute(fft.irfft(channel_sum(
+                                   fft.rfft(seg, padsize, axis=0,
+                                            workers=workers) *
+                                   np.conj(fft.rfft(s1, padsize, axis=0,
+                                                    workers=workers))),
+                               padsize, workers=workers)[:hi - lo])
+    i = len(ca) - 1 - np.argmax(ca[::-1])
+    return ca[i], lo + i
+
+
+def decimate(opts, s, factor, dtype=np.float64, chunk=1 << 16):
+    """signal.resample_poly(s, 1, factor) as dtype.
+
+    In low memory mode, this works through s in chunks, so it never
+    converts the whole track to floating point at once.  The chunks
+    overlap by more than the filter length, which gives the same output.
+    """
+    # scipy.signal takes longer to import than everything else together,
+    # and only the coarse search needs it.
+    from scipy import signal
+    if not opts.low_memory:
+        return signal.resample_poly(np.asarray(s, dtype=dtype), 1, factor)
+    margin = 11 * factor
+    out = []
+    for b in range(0, -(-len(s) // factor), chunk):
+        lo = max(0, b * factor - margin)
+        hi = min(len(s), (b + chunk) * factor + margin)
+        part = signal.resample_poly(np.asarray(s[lo:hi], dtype=dtype), 1,
+                                    factor)
+        skip = (b * factor - lo) // factor
+        out.append(part[skip:skip + chunk])
+    return np.concatenate(out)
+
+
+def band_features(opts, s, hop, sample_rate, bands=24, chunk_frames=4096):
+    """Log band energies of s in frames of hop samples, for matching.
+
+    Frame k covers s[k * hop:k * hop + 4 * hop], and has the energies of
+    up to bands log-spaced bands from 60 Hz to 8 kHz.  Each band is
+    standardized over the track and each frame scaled to unit length, so
+    the dot product of two frames is their similarity from -1 to 1.
+    """
+    nfft = 4 * hop
+    window = np.hanning(nfft).astype(np.float32)
+    freqs = fft.rfftfreq(nfft, 1 / sample_rate)
+    edges = np.geomspace(60, min(8000, sample_rate / 2), bands + 1)
+    band_of = np.searchsorted(edges, freqs, side='right') - 1
+    used = np.unique(band_of[(band_of >= 0) & (band_of < bands)])
+    matrix = (band_of[:, None] == used).astype(np.float32)
+
+    count = max(0, (len(s) - nfft) // hop + 1)
+    features = np.empty((count, len(used)), dtype=np.float32)
+    for a in range(0, count, chunk_frames):
+        b = min(a + chunk_frames, count)
+        x = np.asarray(s[a * hop:(b - 1) * hop + nfft], dtype=np.float32)
+        if x.ndim > 1:
+            x = x.sum(axis=1)
+        frames = np.lib.stride_tricks.sliding_window_view(x, nfft)[::hop]
+        power = np.square(np.abs(fft.rfft(frames * window, axis=1)))
+        features[a:b] = np.log1p(power @ matrix)
+    features -= features.mean(axis=0)
+    features /= np.maximum(features.std(axis=0), 1e-6)
+    features /= np.maximum(np.linalg.norm(features, axis=1,
+                                          keepdims=True), 1e-6)
+    return features
+
+
+def band_features_cached(opts, pcm_key, s, hop, sample_rate):
+    key = None
+    if pcm_key is not None:
+        key = cache_key('features', pcm_key, hop)
+    features = cache_load_array(opts, key)
+    if features is not None:
+        print_maybe(opts, 'Using cached features')
+        return features
+    features = band_features(opts, s, hop, sample_rate)
+    cache_save_array(opts, key, features)
+    return features
+
+
+def coarse_shortlist(opts, s1, s2, factor, init_start, init_end_min,
+                     search_offsets, searchlen_samples, sample_rate,
+                     pbar, pbar_step, dtype=np.float64, pool=None,
+                     spare=None):
+    """Run the loop search on decimated copies of s1 and s2.
+
+    Returns a dict mapping the search offsets of the best
+    loop_search_coarse_candidates candidates to their approximate (full
+    rate) loop end, to be refined at the full sample rate.
+    """
+    s1c = decimate(opts, s1, factor, dtype)
+    s2c = s1c if s2 is s1 else decimate(opts, s2, factor, dtype)
+    return reduced_shortlist(opts, s1, s1c, s2c, factor, init_start,
+                             init_end_min, search_offsets,
+                             searchlen_samples, sample_rate, pbar,
+                             pbar_step, dtype, pool, spare, 'coarse')
+
+
+def feature_shortlist(opts, s1, s2, hop, init_start, init_end_min,
+                      search_offsets, searchlen_samples, sample_rate, pbar,
+                      pbar_step, pcm_key=None, dtype=np.float64, pool=None,
+                      spare=None):
+    """Run the loop search on the band_features frames of s1 and s2.
+
+    Like coarse_shortlist, but each hop samples become a frame of
+    spectral features, whose channels are correlated together.
+    Repeated sections match in their features even where noise or
+    filtering changes the waveform, and there are far fewer frames than
+    samples.
+    """
+    s2f = band_features_cached(opts, pcm_key, s2, hop, sample_rate)
+    s1f = s2f if s2 is s1 else band_features(opts, s1, hop, sample_rate)
+    return reduced_shortlist(opts, s1, s1f, s2f, hop, init_start,
+                             init_end_min, search_offsets,
+                             searchlen_samples, sample_rate, pbar,
+                             pbar_step, dtype, pool, spare, 'features',
+                             unit=True)
+
+
+def reduced_shortlist(opts, s1, s1c, s2c, factor, init_start,
+                      init_end_min, search_offsets, searchlen_samples,
+                      sample_rate, pbar, pbar_step, dtype, pool, spare,
+                      label, unit=False):
+    """The search of coarse_shortlist and feature_shortlist.
+
+    s1c and s2c are s1 and s2 with one element per factor samples.  If
+    unit is set, their elements have unit length, and candidates are
+    scored by their mean similarity rather than normalized by the length
+    of the correlation like samples are.
+    """
+    searchlen_coarse = searchlen_samples // factor
+    with search_threads(opts, spare) as threads:
+        spectra = loop_spectra(opts, s2c, searchlen_coarse, dtype=dtype,
+                               pool=pool, threads=threads)
+    batch = loop_batch_size(opts, spectra, searchlen_coarse, s2c[0].size)
+    search_offsets = np.asarray(search_offsets)
+    scored = []
+    for i in range(0, len(search_offsets), batch):
+        offsets = search_offsets[i:i + batch]
+        this_starts = (init_start + offsets) // factor
+        this_end_mins = (init_end_min + offsets) // factor
+        with search_threads(opts, spare) as threads:
+            this_cas, this_ends = parallel_loop_corrabs(
+                pool, threads, spectra, s1c, s2c, this_starts,
+                this_end_mins, searchlen_coarse)
+        if pbar is not None:
+            pbar.update(pbar_step * len(offsets))
+        if unit:
+            this_normalized_cas = this_cas / searchlen_coarse
+        else:
+            this_normalized_cas = this_cas / (searchlen_coarse *
+                                              (len(s2c) - this_end_mins))
+        this_lengths = this_ends * factor - (init_start + offsets)
+        # The coarse end can be off by a few samples either way, so only
+        # throw out candidates that are clearly outside the limits.
+        ok = ((this_ends >= 0) &
+              (this_ends * factor - factor <= len(s1)) &
+              (this_lengths + factor >= opts.loop_len_min*sample_rate))
+        for j in np.nonzero(ok)[0]:
+            print_maybe(opts, label, "offset", offsets[j],
+                        "end", this_ends[j] * factor,
+                        "normalized_confidence", this_normalized_cas[j])
+            scored.append((this_normalized_cas[j], int(offsets[j]),
+                           int(this_ends[j] * factor)))
+    best = heapq.nlargest(opts.loop_search_coarse_candidates, scored)
+    return {search_offset: this_end
+            for this_normalized_ca, search_offset, this_end in best}
+
+
+def ncc(a, b):
+    """Normalized cross-correlation of a and b at lag 0, from -1 to 1.
+
+    The longer of the two is cut to the length of the shorter.
+    """
+    n = min(len(a), len(b))
+    a = np.asarray(a[:n], dtype=np.float64).ravel()
+    b = np.asarray(b[:n], dtype=np.float64).ravel()
+    norm = math.sqrt(np.dot(a, a) * np.dot(b, b))
+    return float(np.dot(a, b) / norm) if norm else 0.0
+
+
+def loop_verified(opts, s1, s2, start, end, snippetlen, seamlen):
+    """Whether the loop start..end is good enough to stop searching.
+
+    Both the snippet correlated by the search and the samples on either
+    side of the seam must match with a normalized correlation of at least
+    loop_search_early_exit.  ncc only compares the overlap, so a window
+    cut short by either end of the track fails instead of passing on a
+    few samples.
+    """
+    after = max(snippetlen, seamlen)
+    if (min(start, end) < seamlen or start + after > len(s1) or
+            end + after > len(s2)):
+        return False
+    if ncc(s1[start:start + snippetlen],
+           s2[end:end + snippetlen]) < opts.loop_search_early_exit:
+        return False
+    return ncc(s1[start - seamlen:start + seamlen],
+               s2[end - seamlen:end + seamlen]) >= opts.loop_search_early_exit
+
+
+def onset_envelope(s, hop, chunk_frames=4096):
+    """Onset strength of s in frames of hop samples, by spectral flux.
+
+    Each frame's log magnitude spectrum is compared to the previous one,
+    and the increases summed.  Frame k is centered on sample
+    k * hop + 2 * hop.  The envelope is computed a chunk of frames at a
+    time, so only the chunk's spectra are in memory at once.
+    """
+    nfft = 4 * hop
+    window = np.hanning(nfft).astype(np.float32)
+    count = max(0, (len(s) - nfft) // hop + 1)
+    env = np.zeros(count, dtype=np.float32)
+    prev = None
+    for a in range(0, count, chunk_frames):
+        b = min(a + chunk_frames, count)
+        x = np.asarray(s[a * hop:(b - 1) * hop + nfft], dtype=np.float32)
+        if x.ndim > 1:
+            x = x.sum(axis=1)
+        frames = np.lib.stride_tricks.sliding_window_view(x, nfft)[::hop]
+        mag = np.log1p(np.abs(fft.rfft(frames * window, axis=1)))
+        if prev is not None:
+            mag = np.concatenate([prev, mag])
+        env[a:b] = np.maximum(np.diff(mag, axis=0, prepend=mag[:1]),
+                              0).sum(axis=1)[-(b - a):]
+        prev = mag[-1:]
+    return env
+
+
+def beat_frames(env, frame_rate, bpm_min=60, bpm_max=200, tightness=100):
+    """Frames of env that fall on beats, or None if it has no tempo.
+
+    The tempo is the autocorrelation peak of env, weighted towards
+    120 BPM, and the beats are then tracked by dynamic programming as in
+    Ellis, "Beat Tracking by Dynamic Programming" (2007), which allows for
+    small tempo drift.
+    """
+    n = len(env)
+    e = env - env.mean()
+    if n < 2 or not e.any():
+        return None
+    e /= e.std()
+    size = fft.next_fast_len(2 * n, real=True)
+    ac = fft.irfft(np.square(np.abs(fft.rfft(e, size))), size)[:n]
+    lo = max(1, int(frame_rate * 60 / bpm_max))
+    hi = min(n - 1, int(frame_rate * 60 / bpm_min))
+    if lo >= hi:
+        return None
+    lags = np.arange(lo, hi + 1)
+    weight = np.exp(-0.5 * np.square(np.log2(60 * frame_rate / lags / 120)))
+    period = int(lags[np.argmax(ac[lo:hi + 1] * weight)])
+    if ac[period] <= 0:
+        return None
+
+    # The previous beat is between half and twice a period back, and
+    # straying from the period is penalized.
+    back_offsets = np.arange(-2 * period, -(period // 2) + 1)
+    penalty = -tightness * np.square(np.log(-back_offsets / period))
+    score = e.astype(np.float64)
+    backlink = np.full(n, -1)
+    for t in range(-back_offsets[-1], n):
+        first = np.searchsorted(t + back_offsets, 0)
+        candidates = score[t + back_offsets[first:]] + penalty[first:]
+        k = np.argmax(candidates)
+        if candidates[k] > 0:
+            score[t] += candidates[k]
+            backlink[t] = t + back_offsets[first + k]
+
+    beats = [len(score) - period + int(np.argmax(score[-period:]))]
+    while backlink[beats[-1]] >= 0:
+        beats.append(backlink[beats[-1]])
+    return np.array(beats[::-1])
+
+
+def beat_offsets(opts, s, sample_rate, init_start, search_offset_max):
+    """Search offsets at the beats or bars of s, or None if there are none.
+
+    Bars are every fourth beat, in the phase with the strongest onsets.
+    """
+    # 10 ms frames.
+    hop = max(1, sample_rate // 100)
+    env = onset_envelope(s, hop)
+    beats = beat_frames(env, sample_rate / hop)
+    if beats is None:
+        return None
+    if opts.loop_search_candidates == 'bars':
+        phase = max(range(4), key=lambda i: env[beats[i::4]].sum())
+        beats = beats[phase::4]
+    offsets = beats * hop + 2 * hop - init_start
+    offsets = offsets[(offsets >= 0) & (offsets < search_offset_max)]
+    if len(offsets) < 2:
+        return None
+    return offsets
+
+
+def seam_error(s1, s2, start, end, seamlen):
+    """How audible the jump from end back to start is.
+
+    Compares the seamlen samples from start in s1, which play after the
+    jump, with those from end in s2, which would have played without it.
+    This is their RMS difference relative to their RMS level: 0 for a
+    seamless loop, and around 1 for unrelated audio.
+    """
+    width = min(seamlen, len(s1) - start, len(s2) - end)
+    if width <= 0:
+        return None
+    a = np.asarray(s1[start:start + width], dtype=np.float64)
+    b = np.asarray(s2[end:end + width], dtype=np.float64)
+    level = np.square(a).sum() + np.square(b).sum()
+    if not level:
+        return 0.0
+    return float(np.sqrt(2 * np.square(a - b).sum() / level))
+
+
+def windowed_sums(x, width):
+    """Sums of each width consecutive elements of x."""
+    c = np.concatenate([[0], np.cumsum(x)])
+    return c[width:] - c[:-width]
+
+
+def refine_seam(opts, s1, s2, start, end, radius, seamlen, sample_rate):
+    """Sample-accurate loop points within radius samples of start..end.
+
+    First the loop length is adjusted to minimize the squared difference
+    between the seamlen samples from start and those from the new end.
+    Then, keeping that length, the loop start is moved to where the
+    millisecond after the jump matches best, which is where it is least
+    likely to click.  Ties keep the points closest to the original ones.
+
+    Returns the new start and end.
+    """
+    def sq(x):
+        x = np.asarray(x, dtype=np.float64)
+        return np.square(x).sum(axis=1) if x.ndim > 1 else np.square(x)
+
+    def nearest_min(err, center):
+        """Index of the minimum of err closest to center."""
+        tolerance = 1e-9 * np.abs(err).max()
+        candidates = np.flatnonzero(err <= err.min() + tolerance)
+        return candidates[np.argmin(np.abs(candidates - center))]
+
+    # Length: slide the audio after start over the neighbourhood of end.
+    radius = min(radius, end)
+    width = min(seamlen, len(s1) - start, len(s2) - end - radius)
+    if width > 0 and radius > 0:
+        a = np.asarray(s1[start:start + width], dtype=np.float64)
+        seg = np.asarray(s2[end - radius:end + radius + width],
+                         dtype=np.float64)
+        padsize = fft.next_fast_len(len(seg) + width, real=True)
+        corr = fft.irfft(channel_sum(fft.rfft(seg, padsize, axis=0) *
+                                     np.conj(fft.rfft(a, padsize, axis=0))),
+                         padsize)[:2 * radius + 1]
+        err = windowed_sums(sq(seg), width) - 2 * corr
+        end += int(nearest_min(err, radius)) - radius
+
+    # Start: the best matching millisecond, at the same length.
+    length = end - start
+    width = max(1, sample_rate // 1000)
+    lo = max(start - radius, int(opts.loop_start_min * sample_rate))
+    hi = min(start + radius, len(s1) - width, len(s2) - length - width)
+    if lo < hi:
+        diff = sq(np.asarray(s1[lo:hi + width], dtype=np.float64) -
+                  np.asarray(s2[lo + length:hi + length + width],
+                             dtype=np.float64))
+        err = windowed_sums(diff, width)
+        start = lo + int(nearest_min(err, start - lo))
+        end = start + length
+    return start, end
+
+
+def batch_bounds(count, batch, grow=False):
+    """(start, stop) of each batch when splitting count candidates.
+
+    With grow, the batches start small and double up to batch, so that
+    the first candidates are scored (and can end the search) quickly.
+    """
+    bounds = []
+    size = min(4, batch) if grow else batch
+    lo = 0
+    while lo < count:
+        bounds.append((lo, min(lo + size, count)))
+        lo += size
+        size = min(2 * size, batch)
+    return bounds
+
+
+def find_loop(pcm, rate, opts, pcm2=None, pbar=None, pcm_key=None,
+              profiler=None, spare_threads=None):
+    """Find the best loop in decoded audio.
+
+    pcm is the signal to loop at sample rate rate, as returned by
+    normalize_denoise.  If pcm2 is given, the loop end is searched for in
+    it instead of in pcm.  pbar is an optional tqdm progress bar, pcm_key
+    the cache key of the decoded pcm2 (or pcm), which lets its spectra be
+    cached, and profiler an optional Profile to time the search with.
+
+    The candidates of each batch are split between opts.threads threads,
+    plus any that can be borrowed from the semaphore spare_threads.
+
+    With loop_search_features or loop_search_coarse_rate, a cheaper
+    search over spectral features or a decimated copy first picks
+    loop_search_coarse_candidates candidates, and only those are
+    correlated in full.
+
+    Candidates are visited from loop_start_min onward, every
+    loop_search_step seconds, or at the beats or bars found in pcm if
+    loop_search_candidates asks for them.  If loop_candidates is more
+    than 1, the best loops whose lengths differ from each other by at
+    least loop_candidates_separation seconds are kept as alternatives.
+    The best loop is then moved by up to loop_refine seconds with
+    refine_seam.  If loop_search_early_exit is set, the search stops at
+    the first batch whose best candidate passes loop_verified.
+
+    Returns a LoopResult, whose end is 0 if no candidate was found.  All
+    state lives in opts and the arguments, so several searches can run at
+    once in different threads.
+    """
+    s1 = pcm
+    s2 = pcm if pcm2 is None else pcm2
+    sample_rate = rate
+    init_start = int(opts.loop_start_min*sample_rate)
+    searchlen_samples = int(opts.loop_search_len*sample_rate)
+
+    # We don't want to only loop a tiny piece at the end of the file.
+    loopstartmax_samples = math.inf
+    if opts.loop_start_max is not None:
+        loopstartmax_samples = opts.loop_start_max*sample_rate
+    loopstartmax_samples = int(min(loopstartmax_samples, len(s1) * 0.47))
+
+    search_offset_max = len(s1) - searchlen_samples
+    search_offset_max = min(search_offset_max,
+                            loopstartmax_samples - init_start)
+    search_offset_max_seconds = search_offset_max / sample_rate
+    loopsearchstep_samples = int(opts.loop_search_step * sample_rate)
+    # A quarter second on either side of the seam is plenty to hear a
+    # click.
+    seamlen = int(0.25 * sample_rate)
+
+    search_offsets = None
+    if opts.loop_search_candidates != 'grid':
+        with stage(profiler, 'preprocess'):
+            search_offsets = beat_offsets(opts, s1, sample_rate, init_start,
+                                          search_offset_max)
+        if search_offsets is None:
+            print_maybe(opts, 'No beats found, searching a fixed grid')
+        else:
+            print_maybe(opts, 'Searching', len(search_offsets),
+                        opts.loop_search_candidates)
+    if search_offsets is None:
+        search_offsets = np.arange(0, search_offset_max,
+                                   loopsearchstep_samples)
+
+    if pbar is not None:
+        # Progress counts a step per candidate, so that it ends at
+        # search_offset_max_seconds whichever candidates are searched.
+        pbar.reset(total=search_offset_max_seconds)
+        pbar_step = search_offset_max_seconds / max(1, len(search_offsets))
+    else:
+        pbar_step = 0
+    maxthreads = opts.threads or os.cpu_count() or 1
+    if spare_threads is not None:
+        maxthreads = max(maxthreads, os.cpu_count() or 1)
+    with (ThreadPoolExecutor(maxthreads) if maxthreads > 1
+          else contextlib.nullcontext()) as pool:
+        best = find_loop_search(opts, s1, s2, sample_rate, search_offsets,
+                                seamlen, pbar, pbar_step, pcm_key, profiler,
+                                pool, spare_threads)
+
+    def refined(found):
+        start, end = found.start, found.end
+        if opts.loop_refine:
+            start, end = refine_seam(opts, s1, s2, start, end,
+                                     int(opts.loop_refine * sample_rate),
+                                     seamlen, sample_rate)
+        return dataclasses.replace(
+            found, start=start, end=end,
+            seam_error=seam_error(s1, s2, start, end, seamlen))
+
+    if best.end > 0:
+        with stage(profiler, 'refine'):
+            best = dataclasses.replace(
+                refined(best),
+                alternatives=tuple(refined(a) for a in best.alternatives))
+    print_maybe(opts, "best", "start", best.start,
+                "end", best.end, "length", best.length,
+                "confidence", best.confidence,
+                "normalized_confidence", best.normalized_confidence,
+                "seam_error", best.seam_error)
+    for i, a in enumerate(best.alternatives):
+        print_maybe(opts, "alternative", i + 1, "start", a.start,
+                    "end", a.end, "length", a.length,
+                    "confidence", a.confidence,
+                    "normalized_confidence", a.normalized_confidence,
+                    "seam_error", a.seam_error)
+    return best
+
+
+def find_loop_search(opts, s1, s2, sample_rate, search_offsets, seamlen,
+                     pbar, pbar_step, pcm_key, profiler, pool, spare):
+    """The search of find_loop, with pool for its threads."""
+    best_ca = 0
+    best_normalized_ca = 0
+    best_start = 0
+    best_end = 0
+    best_end_min = 0
+    init_start = int(opts.loop_start_min*sample_rate)
+    searchlen_samples = int(opts.loop_search_len*sample_rate)
+    init_end_min = int(opts.loop_end_min*sample_rate)
+    coarse_factor = 0
+    if opts.loop_search_coarse_rate:
+        coarse_factor = sample_rate // opts.loop_search_coarse_rate
+    if opts.loop_search_features:
+        # 20 ms frames.
+        hop = max(1, sample_rate // 50)
+        with stage(profiler, 'correlate'):
+            shortlist = feature_shortlist(opts, s1, s2, hop, init_start,
+                                          init_end_min, search_offsets,
+                                          searchlen_samples, sample_rate,
+                                          pbar, pbar_step, pcm_key,
+                                          dtype=opts.dtype, pool=pool,
+                                          spare=spare)
+        search_offsets = np.array(sorted(shortlist), dtype=int)
+        batch = max(1, len(search_offsets))
+        # Neighbouring frames overlap, so the best frame can be off by a
+        # few hops.
+        refine_radius = 4 * hop
+    elif coarse_factor > 1:
+        with stage(profiler, 'correlate'):
+            shortlist = coarse_shortlist(opts, s1, s2, coarse_factor,
+                                         init_start, init_end_min,
+                                         search_offsets, searchlen_samples,
+                                         sample_rate, pbar, pbar_step,
+                                         dtype=opts.dtype,
+                                         pool=pool, spare=spare)
+        search_offsets = np.array(sorted(shortlist), dtype=int)
+        batch = max(1, len(search_offsets))
+        # Enough slack for the decimation filter and rounding.
+        refine_radius = 4 * coarse_factor
+    else:
+        shortlist = None
+        with stage(profiler, 'correlate'), \
+                search_threads(opts, spare) as threads:
+            spectra = loop_spectra_cached(opts, pcm_key, s2,
+                                          searchlen_samples,
+                                          dtype=opts.dtype, pool=pool,
+                                          threads=threads)
+        batch = loop_batch_size(opts, spectra, searchlen_samples,
+                                s2[0].size)
+
+    early_exit = False
+    top = TopLoops(opts.loop_candidates,
+                   opts.loop_candidates_separation * sample_rate)
+    if opts.loop_search_early_exit:
+        # Where the search stops depends on the batches, so they mustn't
+        # depend on memory_budget; each is still correlated in chunks of
+        # at most batch candidates.
+        bounds = batch_bounds(len(search_offsets), 16, grow=True)
+    else:
+        bounds = batch_bounds(len(search_offsets), batch)
+    for lo, hi in bounds:
+        offsets = search_offsets[lo:hi]
+        this_starts = init_start + offsets
+        this_end_mins = init_end_min + offsets
+        with stage(profiler, 'correlate'), \
+                search_threads(opts, spare) as threads:
+            if shortlist is None:
+                parts = [parallel_loop_corrabs(
+                             pool, threads, spectra, s1, s2,
+                             this_starts[a:b], this_end_mins[a:b],
+                             searchlen_samples)
+                         for a, b in batch_bounds(len(offsets), batch)]
+                this_cas = np.concatenate([cas for cas, ends in parts])
+                this_ends = np.concatenate([ends for cas, ends in parts])
+                if pbar is not None:
+                    pbar.update(pbar_step * len(offsets))
+            else:
+                this_cas = np.zeros(len(offsets))
+                this_ends = np.full(len(offsets), -1)
+
+                def refine(lo, hi):
+                    for j in range(lo, hi):
+                        this_end_guess = shortlist[offsets[j]]
+                        candidate = window_corrabs(
+                            s1[this_starts[j]:][:searchlen_samples], s2,
+                            max(this_end_guess - refine_radius,
+                                this_end_mins[j] + 1),
+                            this_end_guess + refine_radius + 1,
+                            dtype=opts.dtype)
+                        if candidate is not None:
+                            this_cas[j], this_ends[j] = candidate
+                split_map(pool, threads, refine, len(offsets))
+        with stage(profiler, 'score'):
+            this_norm_magnitudes = searchlen_samples * np.maximum(
+                len(s2) - this_end_mins, 1)
+            this_normalized_cas = this_cas / this_norm_magnitudes
+            this_lengths = this_ends - this_starts
+            ok = ((this_ends >= 0) &
+                  (this_ends <= len(s1)) &
+                  (this_lengths >= opts.loop_len_min*sample_rate))
+            if not ok.any():
+                continue
+            # The first of equally good candidates wins, as before.
+            j = np.argmax(np.where(ok, this_normalized_cas, -np.inf))
+            # A candidate that passes the early exit check wins even if
+            # an earlier one that failed it scored higher.
+            early_exit = (opts.loop_search_early_exit and
+                          loop_verified(opts, s1, s2, int(this_starts[j]),
+                                        int(this_ends[j]),
+                                        searchlen_samples, seamlen))
+            if this_normalized_cas[j] > best_normalized_ca or early_exit:
+                best_ca = float(this_cas[j])
+                best_normalized_ca = float(this_normalized_cas[j])
+                best_start = int(this_starts[j])
+                best_end = int(this_ends[j])
+                best_end_min = int(this_end_mins[j])
+            for j in np.nonzero(ok)[0]:
+                print_maybe(opts, "offset", offsets[j],
+                            "start", this_starts[j],
+                            "end", this_ends[j], "length", this_lengths[j],
+                            "confidence", this_cas[j],
+                            "normalized_confidence", this_normalized_cas[j])
+                if opts.loop_candidates > 1:
+                    top.push(float(this_normalized_cas[j]),
+                             int(this_starts[j]), int(this_ends[j]),
+                             int(this_end_mins[j]), float(this_cas[j]))
+        if early_exit:
+            print_maybe(opts, 'Loop verified, stopping search early')
+            break
+    # The best loop may be an early exit that scored lower than others.
+    alternatives = tuple(
+        LoopResult(sample_rate=sample_rate, start=start, end=end,
+                   end_min=end_min, confidence=ca,
+                   normalized_confidence=normalized_ca)
+        for normalized_ca, _, start, end, end_min, ca in top.best()
+        if abs((end - start) - (best_end - best_start)) >= top.separation)
+    return LoopResult(sample_rate=sample_rate, start=best_start,
+                      end=best_end, end_min=best_end_min,
+                      confidence=best_ca,
+                      normalized_confidence=best_normalized_ca,
+                      alternatives=alternatives[:opts.loop_candidates - 1])
+
+
+def loop_result_key(opts, in1, in2):
+    """Cache key for the loop search result of in1 and in2."""
+    return cache_key('loop', decode_key(opts, in1), decode_key(opts, in2),
+                     opts.loop_start_min, opts.loop_start_max,
+                     opts.loop_end_min, opts.loop_len_min,
+                     opts.loop_search_step, opts.loop_search_len,
+                     opts.loop_search_coarse_rate,
+                     opts.loop_search_coarse_candidates,
+                     opts.loop_search_early_exit,
+                     opts.loop_search_features,
+                     opts.loop_search_candidates,
+                     opts.loop_refine,
+                     opts.loop_candidates,
+                     opts.loop_candidates_separation,
+                     opts.single_precision)
+
+
 def cli_parser(**ka):
     from argparse import ArgumentParser, RawDescriptionHelpFormatter
     parser = ArgumentParser(description=file_offset.__doc__,
@@ -205,6 +1909,38 @@ def cli_parser(**ka):
             default=0,
             help="lowpass, just in case, because like with manual sync'ing,\
             the low frequencies matter more. 0 == off. (default: 0)")
+    if 'preprocess' not in ka:
+        parser.add_argument(
+            '--preprocess',
+            dest='preprocess',
+            action='store',
+            default='ffmpeg',
+            choices=['ffmpeg', 'native'],
+            help='How to apply --normalize, --denoise and --lowpass: with ' +
+                 'ffmpeg filters, or "native" approximations in Python ' +
+                 'that skip the slow ffmpeg filters. (default: ffmpeg)')
+    if 'sample-rate' not in ka:
+        parser.add_argument(
+            '--sample-rate',
+            dest='sample-rate',
+            action='store',
+            default=0,
+            type=int,
+            help='Have ffmpeg resample the inputs to this rate while ' +
+                 'decoding. Inputs with different rates are otherwise ' +
+                 'resampled to the higher one after decoding. ' +
+                 '0 == off. (default: 0)')
+    if 'channels' not in ka:
+        parser.add_argument(
+            '--channels',
+            dest='channels',
+            action='store',
+            default='first',
+            choices=['first', 'mono', 'side', 'all'],
+            help='Which channels to correlate: "first" channel only, ' +
+                 '"mono" downmix (mid), "side" (left minus right), or ' +
+                 '"all" channels with their correlations summed (the ' +
+                 'same as mid plus side). (default: first)')
     if 'samples' not in ka:
         parser.add_argument(
             '--samples',
@@ -267,6 +2003,99 @@ def cli_parser(**ka):
             default=5.0,
             type=float,
             help="Snippet length for loop search (seconds). (default: 5)")
+    if 'loop-search-coarse-rate' not in ka:
+        parser.add_argument(
+            '--loop-search-coarse-rate',
+            dest='loop-search-coarse-rate',
+            action='store',
+            default=0,
+            type=int,
+            help="Sample rate (Hz) for a coarse first search pass, e.g. " +
+                 "4000; only the best candidates are then searched at " +
+                 "the full sample rate. Much faster on long tracks, but " +
+                 "may miss the best loop. 0 == off. (default: 0)")
+    if 'loop-search-coarse-candidates' not in ka:
+        parser.add_argument(
+            '--loop-search-coarse-candidates',
+            dest='loop-search-coarse-candidates',
+            action='store',
+            default=8,
+            type=int,
+            help="Number of coarse pass candidates to refine at the " +
+                 "full sample rate. (default: 8)")
+    if 'loop-search-early-exit' not in ka:
+        parser.add_argument(
+            '--loop-search-early-exit',
+            dest='loop-search-early-exit',
+            action='store',
+            default=0.0,
+            type=float,
+            help="Stop searching once a loop's snippet and seam both " +
+                 "match with at least this normalized correlation (up to " +
+                 "1), e.g. 0.99. Much faster on tracks that loop exactly, " +
+                 "but may stop at a worse loop than a full search would " +
+                 "find. 0 == off. (default: 0)")
+    if 'loop-search-features' not in ka:
+        parser.add_argument(
+            '--loop-search-features',
+            dest='loop-search-features',
+            action='store_true',
+            default=False,
+            help="Search for repeated sections in per-frame spectral " +
+                 "features first, and only correlate the samples around " +
+                 "the --loop-search-coarse-candidates best matches. Much " +
+                 "faster than a full search, and less thrown off by " +
+                 "noise than --loop-search-coarse-rate, which it " +
+                 "replaces.")
+    if 'loop-search-candidates' not in ka:
+        parser.add_argument(
+            '--loop-search-candidates',
+            dest='loop-search-candidates',
+            action='store',
+            default='grid',
+            choices=['grid', 'beats', 'bars'],
+            help="Where to try loop starts: every --loop-search-step " +
+                 "seconds, or only at the beats or bars (every 4 beats) " +
+                 "of the track, which are more likely to be where the " +
+                 "composer put the loop. Bars need far fewer " +
+                 "correlations than the grid. Falls back to the grid " +
+                 "if no beat is found. (default: grid)")
+    if 'loop-refine' not in ka:
+        parser.add_argument(
+            '--loop-refine',
+            dest='loop-refine',
+            action='store',
+            default=0.0,
+            type=float,
+            help="Once the best loop is found, move its end and start by " +
+                 "up to this many seconds to where the waveforms on " +
+                 "either side of the seam match best, e.g. 0.01. The " +
+                 "seam error (0 for a seamless loop, around 1 for a " +
+                 "bad one) is reported either way. 0 == off. (default: 0)")
+    if 'loop-candidates' not in ka:
+        parser.add_argument(
+            '--loop-candidates',
+            dest='loop-candidates',
+            action='store',
+            default=1,
+            type=int,
+            help="Number of distinct loops to report, best first. The " +
+                 "best is tagged, and the others are listed in the " +
+                 "result, the crosslooperdir manifest and --show, so you " +
+                 "can pick another without searching again. With " +
+                 "--loop-search-coarse-rate or --loop-search-features, " +
+                 "at most --loop-search-coarse-candidates are found. " +
+                 "(default: 1)")
+    if 'loop-candidates-separation' not in ka:
+        parser.add_argument(
+            '--loop-candidates-separation',
+            dest='loop-candidates-separation',
+            action='store',
+            default=1.0,
+            type=float,
+            help="Loops whose lengths differ by less than this many " +
+                 "seconds count as the same loop for --loop-candidates. " +
+                 "(default: 1)")
     if 'loop-force' not in ka:
         parser.add_argument(
             '--loop-force',
@@ -283,6 +2112,14 @@ def cli_parser(**ka):
             default=False,
             help='Enable seconds-denominated Vorbis Comment tags. Not standardized; may break playback in some software. ' +
                  '(default: only use samples-denominated Vorbis Comment tags)')
+    if 'dry-run' not in ka:
+        parser.add_argument(
+            '--dry-run',
+            dest='dry-run',
+            action='store_true',
+            default=False,
+            help='Print the loop tags that would be written as JSON, ' +
+                 'instead of writing them. (default: write tags)')
     if 'skip' not in ka:
         parser.add_argument(
             '--skip',
@@ -290,6 +2127,82 @@ def cli_parser(**ka):
             action='store_true',
             default=False,
             help='Skip this audio file. (default: process file)')
+    if 'single-precision' not in ka:
+        parser.add_argument(
+            '--single-precision',
+            dest='single-precision',
+            action='store_true',
+            default=False,
+            help='Correlate in float32 instead of float64. Faster and ' +
+                 'uses half the memory, but may pick different loop ' +
+                 'points when candidates are nearly tied. ' +
+                 '(default: float64)')
+    if 'threads' not in ka:
+        parser.add_argument(
+            '--threads',
+            dest='threads',
+            action='store',
+            default=None,
+            type=int,
+            help='Number of threads to use. ' +
+                 '(default: use all hardware threads)')
+    if 'memory-budget' not in ka:
+        parser.add_argument(
+            '--memory-budget',
+            dest='memory-budget',
+            action='store',
+            default=512,
+            type=int,
+            help='Approximate memory (MiB) to use for correlating loop ' +
+                 'candidates in batches. (default: 512)')
+    if 'low-memory' not in ka:
+        parser.add_argument(
+            '--low-memory',
+            dest='low-memory',
+            action='store_true',
+            default=False,
+            help='Keep decoded audio and spectra in memory-mapped ' +
+                 'temporary files instead of in memory. Slower, but lets ' +
+                 'very long tracks be looped without swapping; combine ' +
+                 'with a lower --memory-budget. (default: keep in memory)')
+    if 'profile' not in ka:
+        parser.add_argument(
+            '--profile',
+            dest='profile',
+            action='store',
+            default=None,
+            type=str,
+            help='File to write the time spent in each stage (decode, ' +
+                 'preprocess, cache, correlate, score, tag-write) and ' +
+                 'the peak memory to. (default: no profile)')
+    if 'profile-format' not in ka:
+        parser.add_argument(
+            '--profile-format',
+            dest='profile-format',
+            action='store',
+            default='json',
+            choices=['json', 'chrome'],
+            help='Format of --profile: "json" stage totals, or "chrome" ' +
+                 'trace events for chrome://tracing or Perfetto. ' +
+                 '(default: json)')
+    if 'cache-dir' not in ka:
+        parser.add_argument(
+            '--cache-dir',
+            dest='cache-dir',
+            action='store',
+            default=None,
+            type=str,
+            help='Directory for cached decoded audio, spectra and loop ' +
+                 'search results. (default: $XDG_CACHE_HOME/crosslooper)')
+    if 'cache-size' not in ka:
+        parser.add_argument(
+            '--cache-size',
+            dest='cache-size',
+            action='store',
+            default=2048,
+            type=int,
+            help='Maximum cache size (MiB); least recently used entries ' +
+                 'are evicted first. 0 == off. (default: 2048)')
     if 'verbose' not in ka:
         parser.add_argument(
             '-v', '--verbose',
@@ -310,143 +2223,167 @@ def file_offset(use_argparse=True, **ka):
         args = parser.parse_args().__dict__
         ka.update(args)
 
-    global take, normalize, denoise, lowpass, samples, loop
-    global loopstart, loopstartmax, loopendmin, looplenmin
-    global loopsearchstep, loopsearchlen
-    global loopforce, skip, verbose
-    in1, in2, take, show = ka['in1'], ka['in2'], ka['take'], ka['show']
+    # Callers such as crosslooperdir can pass a Profile to collect timings
+    # of several files; otherwise --profile writes this file's.
+    profiler = ka['profiler'] if 'profiler' in ka else None
+    if profiler is None and ka['profile']:
+        profiler = Profile()
+        try:
+            return file_offset(use_argparse=False,
+                               **dict(ka, profiler=profiler))
+        finally:
+            write_profile(ka['profile'], ka['profile-format'],
+                          [dict(profiler.summary(), file=str(ka['in1']),
+                                process=0, events=profiler.events)])
+
+    opts = Options.from_ka(ka)
+    in1, in2, show = ka['in1'], ka['in2'], ka['show']
     if in2 is None:
         in2 = in1
     in1, in2 = pathlib.Path(in1), pathlib.Path(in2)
-    normalize, denoise, lowpass = ka['normalize'], ka['denoise'], ka['lowpass']
     samples = ka['samples']
     loop = ka['loop']
-    loopstart, loopstartmax = ka['loop-start-min'], ka['loop-start-max']
-    loopendmin, looplenmin = ka['loop-end-min'], ka['loop-len-min']
-    loopsearchstep, loopsearchlen = ka['loop-search-step'], ka['loop-search-len']
     loopseconds = ka['loop-enable-seconds-tags']
-    loopforce, skip, verbose = ka['loop-force'], ka['skip'], ka['verbose']
+    loopforce, skip = ka['loop-force'], ka['skip']
+    # Callers such as crosslooperdir can pass a dict to collect results.
+    result = ka['result'] if 'result' in ka else {}
+    # They can also pass the loop tags they already read (see
+    # read_loop_tags), and defer writing the new ones (see write_tags),
+    # which are left in result['tags'].
+    defertags = ka['defer_tags'] if 'defer_tags' in ka else False
 
-    if loop:
-        mf = mutagen.File(in1)
-        if not isinstance(mf, (ogg.OggFileType, flac.FLAC)):
-            # Not a Vorbis Comment file; fallback to APEv2
-            mf = apev2.APEv2File(in1)
+    # The existing tags only matter if we might keep them.
+    mf = {}
+    if loop and not loopforce:
+        mf = ka['tags'] if 'tags' in ka else read_loop_tags(in1)
 
     if loop and not loopforce:
-        # Check for samples-denominated tags.
-        if 'LOOPSTART' in mf and 'LOOPLENGTH' in mf:
-            # Check for seconds-denominated tags.
-            if not loopseconds or ('LOOP_START' in mf and 'LOOP_END' in mf):
-                print_maybe('Loop tags already present, skipping')
-                return in1, None, None
+        if loop_tags_present(mf, loopseconds):
+            print_maybe(opts, 'Loop tags already present, skipping')
+            result['status'] = 'already-tagged'
+            return in1, None, None
 
     if skip:
-        print_maybe('Skipping')
+        print_maybe(opts, 'Skipping')
+        result['status'] = 'skipped'
         return in1, None, None
 
-    sample_rate, s1, s2 = read_normalized(in1, in2)
+    in1_hash = file_hash(opts, in1) if loop and opts.cache_size else None
+
+    def commit_tags(tags):
+        result['tags'] = tags
+        result['content_hash'] = in1_hash
+        if defertags:
+            return
+        if ka['dry-run']:
+            print(json.dumps({'file': str(in1), 'tags': tags}))
+            return
+        with stage(profiler, 'tag-write'):
+            write_tags(opts, in1, tags, in1_hash)
+
+    # A cached search result lets us skip decoding altogether.  --show
+    # needs the audio, so it always runs the search.
+    result_key = None
+    cached = None
+    if loop and opts.cache_size and not show:
+        result_key = loop_result_key(opts, in1, in2)
+        cached = cache_load_json(opts, result_key)
+    if cached is None:
+        sample_rate, s1, s2 = read_normalized(opts, in1, in2, profiler,
+                                              ka['decoded'] if 'decoded' in ka
+                                              else None)
+    else:
+        sample_rate = cached['rate']
+    # LOOPSTART and LOOPLENGTH count samples of in1 itself, whatever rate
+    # it was searched at: --sample-rate, a higher rate in2 and loudnorm
+    # (which outputs 192 kHz) all change it.
+    tag_rate = sample_rate
+    if loop:
+        tag_rate = file_sample_rate(in1) or sample_rate
+
+    def to_tag(samples):
+        return round(samples * tag_rate / sample_rate)
 
     if loop and loopseconds and not loopforce:
         if 'LOOPSTART' in mf and 'LOOPLENGTH' in mf:
             if 'LOOP_START' not in mf or 'LOOP_END' not in mf:
-                print_maybe('Converting samples loop tags to ' +
+                print_maybe(opts, 'Converting samples loop tags to ' +
                             'seconds loop tags, skipping')
                 best_start = float(mf['LOOPSTART'][0])
-                best_start_seconds = best_start / sample_rate
+                best_start_seconds = best_start / tag_rate
                 best_length = float(mf['LOOPLENGTH'][0])
                 best_end = best_start + best_length
-                best_end_seconds = best_end / sample_rate
-                mf['LOOP_START'] = [str(best_start_seconds)]
-                mf['LOOP_END'] = [str(best_end_seconds)]
-                mf.save()
+                best_end_seconds = best_end / tag_rate
+                commit_tags({'LOOP_START': str(best_start_seconds),
+                             'LOOP_END': str(best_end_seconds)})
+                result.update(status='converted', sample_rate=tag_rate,
+                              loop_start=int(best_start),
+                              loop_length=int(best_length))
                 return in1, None, None
         if 'LOOP_START' in mf and 'LOOP_END' in mf:
             if 'LOOPSTART' not in mf or 'LOOPLENGTH' not in mf:
-                print_maybe('Converting seconds loop tags to ' +
+                print_maybe(opts, 'Converting seconds loop tags to ' +
                             'samples loop tags, skipping')
                 best_start_seconds = float(mf['LOOP_START'][0])
-                best_start = int(best_start_seconds * sample_rate)
+                best_start = int(best_start_seconds * tag_rate)
                 best_end_seconds = float(mf['LOOP_END'][0])
                 best_length_seconds = best_end_seconds - best_start_seconds
-                best_length = int(best_length_seconds * sample_rate)
-                mf['LOOPSTART'] = [str(best_start)]
-                mf['LOOPLENGTH'] = [str(best_length)]
-                mf.save()
+                best_length = int(best_length_seconds * tag_rate)
+                commit_tags({'LOOPSTART': str(best_start),
+                             'LOOPLENGTH': str(best_length)})
+                result.update(status='converted', sample_rate=tag_rate,
+                              loop_start=best_start, loop_length=best_length)
                 return in1, None, None
 
-    init_start = int(loopstart*sample_rate)
-    searchlen_samples = int(loopsearchlen*sample_rate)
+    init_start = int(opts.loop_start_min*sample_rate)
+    searchlen_samples = int(opts.loop_search_len*sample_rate)
 
     if loop:
-        best_ca = 0
-        best_normalized_ca = 0
-        best_start = 0
-        best_start_seconds = 0.0
-        best_end = 0
-        best_end_seconds = 0.0
-        init_end_min = int(loopendmin*sample_rate)
-
-        # We don't want to only loop a tiny piece at the end of the file.
-        loopstartmax_samples = math.inf
-        if loopstartmax is not None:
-            loopstartmax_samples = loopstartmax*sample_rate
-        loopstartmax_samples = int(min(loopstartmax_samples, len(s1) * 0.47))
-
-        search_offset_max = len(s1) - searchlen_samples
-        search_offset_max = min(search_offset_max,
-                                loopstartmax_samples - init_start)
-        search_offset_max_seconds = search_offset_max / sample_rate
-        loopsearchstep_samples = int(loopsearchstep * sample_rate)
-
-        pbar = ka['pbar'] if 'pbar' in ka else tqdm(unit='audio_sec')
-        pbar.set_description(in1.name)
-        pbar.reset(total=search_offset_max_seconds)
-
-        for search_offset in range(0,
-                                   search_offset_max,
-                                   loopsearchstep_samples):
-            this_start = init_start + search_offset
-            this_end_min = init_end_min + search_offset
-            candidate = corrabs(s1[this_start:][:searchlen_samples],
-                                s2[this_end_min:])
-            ls1, ls2, padsize, xmax, ca = candidate
-            this_ca = ca[xmax]
-            this_norm_magnitude = searchlen_samples * (len(s2) - this_end_min)
-            this_normalized_ca = this_ca / this_norm_magnitude
-            this_end = this_end_min + (padsize - xmax)
-            this_length = this_end - this_start
-            if this_end > len(s1):
-                pbar.update(loopsearchstep)
-                continue
-            if this_length < looplenmin*sample_rate:
-                pbar.update(loopsearchstep)
-                continue
-            if this_normalized_ca > best_normalized_ca:
-                best_ca = this_ca
-                best_normalized_ca = this_normalized_ca
-                best_start = this_start
-                best_start_seconds = best_start / sample_rate
-                best_end = this_end
-                best_end_seconds = best_end / sample_rate
-                best_length = this_length
-            print_maybe("offset", search_offset, "start", this_start,
-                        "end", this_end, "length", this_length,
-                        "confidence", this_ca,
-                        "normalized_confidence", this_normalized_ca)
-            pbar.update(loopsearchstep)
-        print_maybe("best", "start", best_start,
-                    "end", best_end, "length", best_length,
-                    "confidence", best_ca,
-                    "normalized_confidence", best_normalized_ca)
+        if cached is not None:
+            print_maybe(opts, 'Using cached loop search result')
+            found = LoopResult.from_json(sample_rate, cached)
+        else:
+            pbar = ka['pbar'] if 'pbar' in ka else tqdm(unit='audio_sec')
+            pbar.set_description(in1.name)
+            found = find_loop(s1, sample_rate, opts, s2, pbar=pbar,
+                              pcm_key=(cache_key(decode_key(opts, in2),
+                                                 sample_rate)
+                                       if opts.cache_size else None),
+                              profiler=profiler,
+                              spare_threads=(ka['spare_threads']
+                                             if 'spare_threads' in ka
+                                             else None))
+            if found.end > 0:
+                cache_save_json(opts, result_key,
+                                dict(found.to_json(), rate=sample_rate))
+        if found.end <= 0:
+            raise ValueError(f'No loop found in {in1}')
+        best_ca = found.confidence
+        best_normalized_ca = found.normalized_confidence
+        best_start = found.start
+        best_start_seconds = best_start / sample_rate
+        best_end = found.end
+        best_end_seconds = best_end / sample_rate
+        best_end_min = found.end_min
+        best_length = found.length
     else:
-        ls1, ls2, padsize, xmax, ca = corrabs(s1[init_start:][:searchlen_samples], s2)
+        ls1, ls2, padsize, xmax, ca = corrabs(s1[init_start:][:searchlen_samples], s2,
+                                              dtype=opts.dtype)
+    if loop and show:
+        # The loop search doesn't keep full correlations around, so redo
+        # the winning candidate's for plotting.
+        ls1, ls2, padsize, xmax, ca = corrabs(
+            s1[best_start:][:searchlen_samples], s2[best_end_min:],
+            dtype=opts.dtype)
     if show:
         show1(sample_rate, ca, title='Correlation', v=xmax/sample_rate)
+    if loop and show and found.alternatives:
+        show_loops(sample_rate, s1, (found,) + found.alternatives,
+                   title='Loop candidates (%s)' % in1)
     if loop:
         sync_text = f"""
 ==============================================================================
-{in1} needs tags 'LOOPSTART={int(best_start)} LOOPLENGTH={int(best_length)}'
+{in1} needs tags 'LOOPSTART={to_tag(best_start)} LOOPLENGTH={to_tag(best_length)}'
 ==============================================================================
 """
     elif samples:
@@ -461,7 +2398,9 @@ def file_offset(use_argparse=True, **ka):
 %s needs 'ffmpeg -ss %s' cut to get in sync
 ==============================================================================
 """
-    if xmax > padsize // 2:
+    if loop and not show:
+        file, offset = in2, best_end - best_end_min
+    elif xmax > padsize // 2:
         if show:
             show2(sample_rate, s1, s2[padsize-xmax:],
                   title='1st=blue;2nd=red=cut(%s;%s)' % (in1, in2))
@@ -474,16 +2413,33 @@ def file_offset(use_argparse=True, **ka):
     if not samples:
         offset = offset / sample_rate
     if loop:
-        print_maybe(sync_text)
-        mf['LOOPSTART'] = [str(best_start)]
-        mf['LOOPLENGTH'] = [str(best_length)]
+        print_maybe(opts, sync_text)
+        tags = {'LOOPSTART': str(to_tag(best_start)),
+                'LOOPLENGTH': str(to_tag(best_length))}
         if loopseconds:
-            mf['LOOP_START'] = [str(best_start_seconds)]
-            mf['LOOP_END'] = [str(best_end_seconds)]
-        mf.save()
+            tags['LOOP_START'] = str(best_start_seconds)
+            tags['LOOP_END'] = str(best_end_seconds)
+        commit_tags(tags)
+        result.update(status='tagged', sample_rate=tag_rate,
+                      loop_start=to_tag(best_start),
+                      loop_length=to_tag(best_length),
+                      confidence=float(best_ca),
+                      normalized_confidence=float(best_normalized_ca),
+                      seam_error=found.seam_error)
+        if found.alternatives:
+            result['alternatives'] = [
+                {'loop_start': to_tag(a.start),
+                 'loop_length': to_tag(a.length),
+                 'confidence': float(a.confidence),
+                 'normalized_confidence': float(a.normalized_confidence),
+                 'seam_error': a.seam_error}
+                for a in found.alternatives]
         return file, offset, best_ca
     else:
-        print_maybe(sync_text % (file, offset))
+        print_maybe(opts, sync_text % (file, offset))
+    result.update(status='synced', sample_rate=sample_rate,
+                  file=str(file), offset=float(offset),
+                  confidence=float(ca[xmax]))
     return file, offset, ca[xmax]
 
 
@@ -1,20 +1,32 @@
 #!/usr/bin/env python3
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import configparser
 from copy import deepcopy
 import json
-from multiprocessing import Process, Queue, Lock
+from multiprocessing import (Process, Queue, Lock, Semaphore, RawArray,
+                             resource_tracker, shared_memory)
 import os
 from pathlib import Path
+import queue
 import re
+import threading
+import time
+# resource is Unix only; without it, --memory-limit is ignored.
+try:
+    import resource
+except ModuleNotFoundError:
+    resource = None
 # tomllib is Python 3.11+ only; import a compat shim for older Pythons.
 try:
     import tomllib
 except ModuleNotFoundError:
     import tomli as tomllib
 
+import mutagen
+from mutagen import flac, mp3, mp4, ogg, wave
 from tqdm import tqdm
-import find_engine
 
 import crosslooper
 import crosslooperpresets
@@ -22,6 +34,17 @@ import crosslooperpresets
 __version__ = crosslooper.__version__
 __author__ = crosslooper.__author__
 
+# Options that don't change the result of processing a file.
+manifest_ignored_options = {'in1', 'in2', 'show', 'verbose',
+                            'in-dir', 'preset-conf', 'game-title',
+                            'game-dir', 'game-engine', 'game-engine-ver',
+                            'threads', 'manifest', 'cache-dir', 'cache-size',
+                            'memory-budget', 'memory-limit', 'low-memory',
+                            'profile', 'profile-format', 'dry-run',
+                            'decode-jobs'}
+
+supported_audio = (ogg.OggFileType, flac.FLAC, mp3.MP3, wave.WAVE, mp4.MP4)
+
 
 def cli_parser(**ka):
     parser = crosslooper.cli_parser(**ka)
@@ -80,41 +103,327 @@ def cli_parser(**ka):
             type=str,
             help='Game engine version, e.g. "VX Ace". ' +
                  '(default: auto-detect)')
-    if 'threads' not in ka:
+    if 'manifest' not in ka:
         parser.add_argument(
-            '--threads',
-            dest='threads',
+            '--manifest',
+            dest='manifest',
             action='store',
             default=None,
+            type=str,
+            help='JSONL file recording the result, timing and options of ' +
+                 'each track. Tracks already completed with the same ' +
+                 'options are skipped on later runs. ' +
+                 '(default: no manifest)')
+    if 'memory-limit' not in ka:
+        parser.add_argument(
+            '--memory-limit',
+            dest='memory-limit',
+            action='store',
+            default=0,
+            type=int,
+            help='Maximum memory (MiB) per worker. A track that needs ' +
+                 'more fails instead of pushing the machine into swap; ' +
+                 'try --low-memory for those. Unix only. 0 == no limit. ' +
+                 '(default: 0)')
+    if 'decode-jobs' not in ka:
+        parser.add_argument(
+            '--decode-jobs',
+            dest='decode-jobs',
+            action='store',
+            default=2,
             type=int,
-            help='Number of threads to use. ' +
-                 '(default: use all hardware threads)')
+            help='Number of tracks to decode with ffmpeg at once, ahead ' +
+                 'of the workers that search them, so that the workers ' +
+                 "don't wait for ffmpeg. (default: 2)")
 
     return parser
 
 
+def file_ka(ka, presets, f):
+    this_ka = deepcopy(ka)
+    this_ka['in1'] = f
+
+    for preset_name in presets:
+        if preset_name in f.stem.lower():
+            this_ka.update(presets[preset_name])
+            break
+
+    return this_ka
+
+
+def manifest_options(this_ka):
+    return {k: this_ka[k] for k in sorted(this_ka)
+            if k not in manifest_ignored_options}
+
+
+def manifest_stat(f):
+    st = f.stat()
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def manifest_load(manifest):
+    records = {}
+    if manifest is None or not manifest.exists():
+        return records
+    with open(manifest, 'r', encoding='utf-8') as manifestfile:
+        for line in manifestfile:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Probably a line cut short by a killed run.
+                continue
+            records[record['file']] = record
+    return records
+
+
+def manifest_done(record, f, this_ka):
+    if record is None or record['status'] != 'ok':
+        return False
+    if record['options'] != manifest_options(this_ka):
+        return False
+    try:
+        return record['stat'] == manifest_stat(f)
+    except OSError:
+        return False
+
+
+def discover_file(f, this_ka):
+    """Classify f by probing its header.
+
+    Returns the kind of file ('audio', 'tagged', 'skipped' or
+    'unsupported'), its duration in seconds, and the loop tags that
+    file_offset needs (see crosslooper.read_loop_tags), so that it doesn't
+    have to read them again.
+    """
+    if not f.is_file():
+        return 'unsupported', 0.0, {}
+    try:
+        mf = mutagen.File(f)
+    except (mutagen.MutagenError, OSError):
+        return 'unsupported', 0.0, {}
+    if not isinstance(mf, supported_audio):
+        return 'unsupported', 0.0, {}
+    duration = mf.info.length
+    if this_ka['skip']:
+        return 'skipped', duration, {}
+    tags = {}
+    if this_ka['loop'] and not this_ka['loop-force']:
+        try:
+            tags = crosslooper.read_loop_tags(f, mf)
+        except (mutagen.MutagenError, OSError):
+            return 'unsupported', duration, {}
+        if crosslooper.loop_tags_present(
+                tags, this_ka['loop-enable-seconds-tags']):
+            return 'tagged', duration, tags
+    return 'audio', duration, tags
+
+
+class BorrowedThreads:
+    """spare_threads, counting the threads that one worker has borrowed.
+
+    A worker that is killed can't give back the threads it borrowed, so
+    route() gives back borrowed[process_num] for it.  Only the worker
+    writes its count, so borrowed needs no lock between processes.
+    """
+
+    def __init__(self, spare_threads, borrowed, process_num):
+        self.spare_threads = spare_threads
+        self.borrowed = borrowed
+        self.process_num = process_num
+        self.lock = threading.Lock()
+
+    def acquire(self, block=True):
+        if not self.spare_threads.acquire(block):
+            return False
+        with self.lock:
+            self.borrowed[self.process_num] += 1
+        return True
+
+    def release(self):
+        with self.lock:
+            self.borrowed[self.process_num] -= 1
+        self.spare_threads.release()
+
+
 def loop_process_run(input_file_queue, progress_queue, pbar_lock, process_num,
-                     ka, presets):
+                     ka, presets, spare_threads, borrowed):
     tqdm.set_lock(pbar_lock)
+    spare_threads = BorrowedThreads(spare_threads, borrowed, process_num)
     single_pbar = tqdm(unit='audio_sec', position=process_num+1)
 
+    if ka['memory-limit'] and resource is not None:
+        limit = ka['memory-limit'] * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
     while True:
-        finished, f = input_file_queue.get()
+        finished, f, tags, decoded = input_file_queue.get()
         if finished:
             break
 
-        this_ka = deepcopy(ka)
-        this_ka['in1'] = f
-
-        for preset_name in presets:
-            if preset_name in f.stem.lower():
-                this_ka.update(presets[preset_name])
-                break
-
-        crosslooper.file_offset(use_argparse=False, pbar=single_pbar,
-                                **this_ka)
-
-        progress_queue.put(1)
+        if decoded is not None:
+            # Copy the stream out of shared memory, since the samples may
+            # end up as views of it.
+            shm = shared_memory.SharedMemory(decoded['name'])
+            try:
+                decoded = bytearray(shm.buf[:decoded['size']])
+            finally:
+                shm.close()
+
+        this_ka = file_ka(ka, presets, f)
+        # Each worker searches with one thread of its own, plus any that
+        # idle workers have handed to spare_threads.
+        this_ka['threads'] = 1
+
+        result = {}
+        profiler = crosslooper.Profile()
+        record = {'file': f, 'options': manifest_options(this_ka)}
+        start_time = time.perf_counter()
+        try:
+            crosslooper.file_offset(use_argparse=False, pbar=single_pbar,
+                                    result=result, profiler=profiler,
+                                    spare_threads=spare_threads,
+                                    tags=tags, defer_tags=True,
+                                    decoded=decoded, **this_ka)
+            record['status'] = 'ok'
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = f'{type(e).__name__}: {e}'
+        record['seconds'] = time.perf_counter() - start_time
+        record['result'] = result
+        record['profile'] = profiler.summary()
+        if ka['profile']:
+            # Only needed for the --profile report, not the manifest.
+            record['events'] = profiler.events
+        try:
+            record['stat'] = manifest_stat(f)
+        except OSError:
+            record['stat'] = None
+
+        progress_queue.put((process_num, record))
+
+
+def loop_process_start(progress_queue, pbar_lock, process_num, ka, presets,
+                       spare_threads, borrowed):
+    input_file_queue = Queue()
+    p = Process(target=loop_process_run,
+                args=(input_file_queue,
+                      progress_queue,
+                      pbar_lock,
+                      process_num,
+                      ka,
+                      presets,
+                      spare_threads,
+                      borrowed))
+    p.start()
+    return p, input_file_queue
+
+
+def needs_decode(this_ka, f):
+    """Whether the worker for f would run ffmpeg on it."""
+    opts = crosslooper.Options.from_ka(this_ka)
+    if not opts.cache_size:
+        return True
+    if this_ka['loop'] and crosslooper.cache_load_json(
+            opts, crosslooper.loop_result_key(opts, f, f)) is not None:
+        return False
+    return not crosslooper.pcm_cached(opts, f)
+
+
+async def decode_ahead(this_ka, f):
+    """Run the ffmpeg command of f's worker into shared memory.
+
+    Returns a dict with the SharedMemory holding the WAV stream, its size,
+    and the start and duration of the decode, or None if the worker
+    doesn't need it.  The caller unlinks the SharedMemory once the worker
+    is done.  If ffmpeg fails or can't be run, this returns None too, and
+    the worker runs ffmpeg again and reports the error as usual.  With
+    --low-memory, the worker decodes into its own memory-mapped file
+    instead.
+    """
+    if this_ka['low-memory']:
+        return None
+    # needs_decode hashes the file, which mustn't hold up the event loop.
+    if not await asyncio.get_running_loop().run_in_executor(
+            None, needs_decode, this_ka, f):
+        return None
+    opts = crosslooper.decode_options(crosslooper.Options.from_ka(this_ka))
+    command, filters = crosslooper.decode_command(opts)
+    command = crosslooper.format_command(opts, command, f, filters)
+    start = time.time()
+    counter = time.perf_counter()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *command, stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL)
+    except OSError:
+        return None
+    data = await proc.stdout.read()
+    if await proc.wait() or not data:
+        return None
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    return {'shm': shm, 'size': len(data), 'start': start,
+            'seconds': time.perf_counter() - counter}
+
+
+def add_stage(record, name, start, seconds):
+    """Add time spent on record's file outside its worker."""
+    if 'profile' not in record:
+        return
+    stages = record['profile']['stages']
+    stages[name] = stages.get(name, 0) + seconds
+    if 'events' in record:
+        record['events'].append({'stage': name, 'start': start,
+                                 'seconds': seconds})
+
+
+def commit_tags(record, this_ka):
+    """Write the tags that a worker planned for its file.
+
+    Workers leave writing to the main process, so that each file is
+    opened and saved once, by one writer.  With --dry-run, nothing is
+    written, and the record's status is 'planned' instead of 'ok', so
+    that a later run still processes the file.
+    """
+    result = record['result']
+    if record['status'] != 'ok' or 'tags' not in result:
+        return
+    if this_ka['dry-run']:
+        record['status'] = 'planned'
+        return
+    start = time.time()
+    counter = time.perf_counter()
+    try:
+        crosslooper.write_tags(crosslooper.Options.from_ka(this_ka),
+                               record['file'], result['tags'],
+                               result['content_hash'])
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = f'{type(e).__name__}: {e}'
+    add_stage(record, 'tag-write', start, time.perf_counter() - counter)
+    # Writing tags changed the file.
+    try:
+        record['stat'] = manifest_stat(record['file'])
+    except OSError:
+        record['stat'] = None
+
+
+def record_result(record, indir, manifestfile, profiles=None, process=0):
+    record['file'] = record['file'].relative_to(indir).as_posix()
+    if record['status'] == 'failed':
+        tqdm.write(f'Failed to process {record["file"]}: ' +
+                   record['error'])
+    elif record['status'] == 'planned':
+        tqdm.write(json.dumps({'file': record['file'],
+                               'tags': record['result']['tags']}))
+    events = record.pop('events', [])
+    if profiles is not None and 'profile' in record:
+        profiles.append(dict(record['profile'], file=record['file'],
+                             process=process, events=events))
+    if manifestfile is not None:
+        manifestfile.write(json.dumps(record) + '\n')
+        manifestfile.flush()
 
 
 def file_offset_dir(**ka):
@@ -142,6 +451,8 @@ def file_offset_dir(**ka):
     indir = ka['in-dir']
     gametitle = ka['game-title']
     if indir is None or gametitle is None:
+        # Only needed without --in-dir and --game-title.
+        import find_engine
         gameengine = ka['game-engine']
         gameenginever = ka['game-engine-ver']
         detected_gameengine = None
@@ -228,9 +539,8 @@ def file_offset_dir(**ka):
     if gametitle is None:
         raise Exception('Failed to detect game title')
 
-    total_pbar = tqdm(unit='track', position=0)
+    total_pbar = tqdm(unit='audio_sec', position=0)
     total_pbar.set_description('folder' if gametitle is None else gametitle)
-    total_pbar.reset(total=len(files))
 
     # Find preset file for game title
     if presetconf is None and gametitle is not None:
@@ -250,44 +560,243 @@ def file_offset_dir(**ka):
         for option in presets_tmp[trackname]:
             option_l = option.lower()
             if option_l not in ['normalize', 'denoise', 'lowpass',
+                                'preprocess', 'sample-rate', 'channels',
                                 'loop-start-min', 'loop-start-max',
                                 'loop-end-min', 'loop-len-min',
                                 'loop-search-step', 'loop-search-len',
+                                'loop-search-coarse-rate',
+                                'loop-search-coarse-candidates',
+                                'loop-search-early-exit',
+                                'loop-search-features',
+                                'loop-search-candidates',
+                                'loop-refine', 'loop-candidates',
+                                'loop-candidates-separation',
                                 'loop-force', 'skip']:
                 raise Exception(f'Unknown TOML option: {option}')
             presets[trackname_l][option_l] = presets_tmp[trackname][option]
 
-    input_file_queue = Queue()
+    # Skip tracks that a previous run already completed.
+    manifest = ka['manifest']
+    if manifest is not None:
+        manifest = Path(manifest)
+    manifest_records = manifest_load(manifest)
+    todo = []
+    for f in files:
+        name = f.relative_to(indir).as_posix()
+        if manifest_done(manifest_records.get(name), f,
+                         file_ka(ka, presets, f)):
+            continue
+        todo.append(f)
+    if len(todo) < len(files):
+        tqdm.write(f'Skipping {len(files) - len(todo)} tracks completed ' +
+                   'in a previous run')
+    files = todo
 
     process_num = ka['threads']
     if process_num is None:
         process_num = os.cpu_count()
+
+    # Probe headers up front so that only real work reaches the workers.
+    with ThreadPoolExecutor(process_num) as pool:
+        kinds = list(pool.map(lambda f: discover_file(f, file_ka(ka, presets,
+                                                                 f)),
+                              files))
+    durations = {}
+    existing_tags = {}
+    counts = {'audio': 0, 'tagged': 0, 'skipped': 0, 'unsupported': 0}
+    for f, (kind, duration, tags) in zip(files, kinds):
+        counts[kind] += 1
+        if kind == 'audio':
+            durations[f] = duration
+            existing_tags[f] = tags
+    tqdm.write(f'{counts["audio"]} tracks to process, ' +
+               f'{counts["tagged"]} already tagged, ' +
+               f'{counts["skipped"]} skipped, ' +
+               f'{counts["unsupported"]} unsupported files')
+
+    # Start the longest tracks first, so that a long track doesn't end up
+    # running alone on one core at the end.
+    files = sorted(durations, key=durations.get, reverse=True)
+    total_pbar.reset(total=sum(durations.values()))
+
+    thread_num = process_num
     process_num = min([process_num, len(files)])
 
+    manifestfile = None
+    if manifest is not None:
+        manifestfile = open(manifest, 'a', encoding='utf-8')
+    profiles = [] if ka['profile'] else None
+
+    asyncio.run(run_pipeline(ka, presets, files, existing_tags, durations,
+                             indir, manifestfile, profiles, total_pbar,
+                             pbar_lock, process_num, thread_num))
+
+    if manifestfile is not None:
+        manifestfile.close()
+    if profiles is not None:
+        crosslooper.write_profile(ka['profile'], ka['profile-format'],
+                                  profiles)
+
+
+async def run_pipeline(ka, presets, files, existing_tags, durations, indir,
+                       manifestfile, profiles, total_pbar, pbar_lock,
+                       process_num, thread_num):
+    """Process files in a pipeline of three stages.
+
+    Up to --decode-jobs ffmpeg processes decode the files, in order, into
+    shared memory.  process_num worker processes each take the next
+    decoded file and search it, so a worker rarely waits for ffmpeg.  A
+    single writer then writes the tags of each finished file and records
+    it, while its worker moves on.  Decoded files wait for a worker in a
+    queue of process_num, so decoding doesn't run far ahead.
+    """
+    loop = asyncio.get_running_loop()
     progress_queue = Queue()
 
-    loop_processes = []
-    for p in range(process_num):
-        loop_processes.append(Process(target=loop_process_run,
-                                      args=(input_file_queue,
-                                            progress_queue,
-                                            pbar_lock,
-                                            p,
-                                            ka,
-                                            presets)))
-
-    for p in loop_processes:
-        p.start()
-
-    for f in files:
-        input_file_queue.put((False, f))
-
-    for f in files:
-        progress_queue.get()
-        total_pbar.update(1)
-
-    for p in loop_processes:
-        input_file_queue.put((True, None))
+    # Threads that no worker is using; workers borrow them to split their
+    # own track's search.  Each worker that runs out of tracks adds its
+    # thread, so a long track at the end of the run gets all the cores.
+    spare_threads = Semaphore(0)
+    for t in range(thread_num - process_num):
+        spare_threads.release()
+    # How many of them each worker has borrowed.
+    borrowed = RawArray('i', process_num)
+
+    # Workers that start their own resource tracker would have it unlink
+    # the decoded files' shared memory when they exit, so start one that
+    # they all inherit.
+    resource_tracker.ensure_running()
+
+    # Each worker gets one file at a time through its own queue, so we
+    # always know which file a worker that died was working on.
+    loop_processes = [loop_process_start(progress_queue, pbar_lock, p, ka,
+                                         presets, spare_threads, borrowed)
+                      for p in range(process_num)]
+    working = {}
+    records = {}
+    ready = asyncio.Queue(maxsize=max(1, process_num))
+    decode_slots = asyncio.Semaphore(max(1, ka['decode-jobs']))
+    finished = asyncio.Queue()
+    stopped = False
+    # Shared memory of decoded files that no worker has finished with.
+    decoded_shms = set()
+
+    def free(shm):
+        decoded_shms.discard(shm)
+        shm.close()
+        shm.unlink()
+
+    async def decode(f):
+        # Keep the slot until a worker has room for the file, so that at
+        # most --decode-jobs decoded files wait outside the queue.
+        try:
+            decoded = await decode_ahead(file_ka(ka, presets, f), f)
+            if decoded is not None:
+                decoded_shms.add(decoded['shm'])
+            await ready.put((f, decoded))
+        finally:
+            decode_slots.release()
+
+    async def decode_all():
+        # Start the decodes in order, but let them finish in any order.
+        tasks = []
+        for f in files:
+            await decode_slots.acquire()
+            tasks.append(asyncio.create_task(decode(f)))
+        await asyncio.gather(*tasks)
+        for p in range(process_num):
+            await ready.put(None)
+
+    async def work(p):
+        while True:
+            item = await ready.get()
+            if item is None:
+                spare_threads.release()
+                return
+            f, decoded = item
+            working[p] = f
+            records[p] = loop.create_future()
+            loop_processes[p][1].put((False, f, existing_tags[f],
+                                      decoded and {
+                                          'name': decoded['shm'].name,
+                                          'size': decoded['size']}))
+            record = await records[p]
+            if decoded is not None:
+                free(decoded['shm'])
+                add_stage(record, 'decode', decoded['start'],
+                          decoded['seconds'])
+            await finished.put((p, f, record))
+
+    def get_progress():
+        try:
+            return progress_queue.get(timeout=1)
+        except queue.Empty:
+            return None
+
+    async def route():
+        """Pass each worker's record to its work(), or restart it if it
+        died."""
+        while not stopped:
+            progress = await loop.run_in_executor(None, get_progress)
+            if progress is not None:
+                p, record = progress
+                if working.get(p) != record['file']:
+                    # A worker we already gave up on and replaced.
+                    continue
+                del working[p]
+                records[p].set_result(record)
+                continue
+            for p, (process, input_file_queue) in enumerate(loop_processes):
+                if process.exitcode is None or p not in working:
+                    continue
+                f = working.pop(p)
+                # Give back the threads it died holding.
+                for i in range(borrowed[p]):
+                    spare_threads.release()
+                borrowed[p] = 0
+                loop_processes[p] = loop_process_start(progress_queue,
+                                                       pbar_lock, p, ka,
+                                                       presets,
+                                                       spare_threads,
+                                                       borrowed)
+                records[p].set_result({
+                    'file': f,
+                    'options': manifest_options(file_ka(ka, presets, f)),
+                    'status': 'failed',
+                    'error': 'Worker exited with code ' +
+                             str(process.exitcode),
+                    'result': {}})
+
+    async def write_all():
+        # One thread writes all the tags, so each file is opened and saved
+        # once, by one writer.
+        with ThreadPoolExecutor(1) as writer:
+            for i in range(len(files)):
+                p, f, record = await finished.get()
+                await loop.run_in_executor(writer, commit_tags, record,
+                                           file_ka(ka, presets, f))
+                record_result(record, indir, manifestfile, profiles, p)
+                total_pbar.update(durations[f])
+
+    router = asyncio.create_task(route())
+    try:
+        await asyncio.gather(decode_all(), write_all(),
+                             *(work(p) for p in range(process_num)))
+    except BaseException:
+        # Nothing will record the tracks that the workers are on, so don't
+        # wait for them.
+        for process, input_file_queue in loop_processes:
+            process.terminate()
+        raise
+    finally:
+        stopped = True
+        await router
+        for process, input_file_queue in loop_processes:
+            input_file_queue.put((True, None, None, None))
+        for process, input_file_queue in loop_processes:
+            process.join()
+        for shm in list(decoded_shms):
+            free(shm)
 
 
 main = file_offset_dir
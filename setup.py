@@ -33,7 +33,7 @@ setup(
                       'tomli >= 1.1.0 ; python_version < "3.11"'],
     setup_requires=['stpl',
                     'restview'],
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     keywords='media audio file synchronization looping metadata rpg maker',
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -0,0 +1,114 @@
+"""The loop search must pick the same loops as the original search.
+
+The original search ran corrabs on each candidate in turn.  find_loop and
+loop_corrabs share FFTs between candidates instead, which must not change
+the loop they pick.
+"""
+
+import dataclasses
+import math
+import os
+import sys
+
+import numpy as np
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import crosslooper  # noqa: E402
+
+rate = 1000
+# A 200 sample snippet, so that the 20003 sample tracks span dozens of
+# overlap-save blocks, the last of them partial, and a small enough
+# memory budget to split the candidates into several batches.
+base = crosslooper.Options(loop_start_min=0.5, loop_end_min=2.0,
+                           loop_search_step=0.25, loop_search_len=0.2,
+                           threads=1, cache_size=0, memory_budget=1)
+
+
+def track(seed, channels=None, n=20003, intro=1700, body=9000, repeat=3000):
+    """Random int16 samples whose first repeat samples of the body repeat
+    after it, with noise.
+
+    Candidates outside the repeat peak at random ends, so they compete
+    when loop_len_min rules out the real loop.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (n,) if channels is None else (n, channels)
+    s = rng.integers(-8000, 8000, size=shape).astype(np.int16)
+    s[intro + body:][:repeat] = (s[intro:][:repeat] // 2 +
+                                 s[intro + body:][:repeat] // 8)
+    return s
+
+
+def per_step_search(opts, s):
+    """The original loop search: corrabs for each candidate in turn."""
+    init_start = int(opts.loop_start_min * rate)
+    searchlen = int(opts.loop_search_len * rate)
+    init_end_min = int(opts.loop_end_min * rate)
+    startmax = math.inf
+    if opts.loop_start_max is not None:
+        startmax = opts.loop_start_max * rate
+    startmax = int(min(startmax, len(s) * 0.47))
+    offset_max = min(len(s) - searchlen, startmax - init_start)
+    best = (0, 0, 0, 0)
+    for offset in range(0, offset_max, int(opts.loop_search_step * rate)):
+        start = init_start + offset
+        end_min = init_end_min + offset
+        ls1, ls2, padsize, xmax, ca = crosslooper.corrabs(
+            s[start:][:searchlen], s[end_min:])
+        normalized = ca[xmax] / (searchlen * (len(s) - end_min))
+        end = end_min + (padsize - xmax)
+        if end > len(s) or end - start < opts.loop_len_min * rate:
+            continue
+        if normalized > best[0]:
+            best = (normalized, start, end, ca[xmax])
+    return best
+
+
+@pytest.mark.parametrize('seed, channels, loop_len_min', [
+    (0, None, 0.0),
+    (1, None, 0.0),
+    # Longer than the real loop, so that only worse candidates pass.
+    (2, None, 9.5),
+    (3, 2, 0.0),
+    (4, 2, 12.0),
+])
+def test_find_loop_matches_per_step_search(seed, channels, loop_len_min):
+    opts = dataclasses.replace(base, loop_len_min=loop_len_min)
+    s = track(seed, channels)
+    normalized, start, end, ca = per_step_search(opts, s)
+    assert end > 0
+    found = crosslooper.find_loop(s, rate, opts)
+    assert (found.start, found.end) == (start, end)
+    assert found.confidence == pytest.approx(ca, rel=1e-9)
+    assert found.normalized_confidence == pytest.approx(normalized,
+                                                        rel=1e-9)
+
+
+@pytest.mark.parametrize('channels', [None, 2])
+def test_loop_corrabs_matches_corrabs(channels):
+    s = track(5, channels)
+    snippetlen = 200
+    spectra = crosslooper.loop_spectra(base, s, snippetlen)
+    blocklen, blockstep, dtype, blocks = spectra
+    assert len(blocks) > 4
+    rng = np.random.default_rng(6)
+    starts = rng.integers(0, len(s) - snippetlen, size=40)
+    # Tails starting anywhere, including in the partial last block.
+    tail_starts = np.concatenate([
+        rng.integers(0, len(s) - 1, size=30),
+        np.arange(len(s) - 10, len(s))])
+    cas, ends = crosslooper.loop_corrabs(spectra, s, s, starts, tail_starts,
+                                         snippetlen)
+    for start, tail_start, ca, end in zip(starts, tail_starts, cas, ends):
+        ls1, ls2, padsize, xmax, ref = crosslooper.corrabs(
+            s[start:][:snippetlen], s[tail_start:])
+        ref_end = tail_start + (padsize - xmax)
+        if ref_end > len(s):
+            # A peak at a non-positive lag.
+            assert end == -1
+        else:
+            assert end == ref_end
+            assert ca == pytest.approx(ref[xmax], rel=1e-9)